@@ -0,0 +1,119 @@
+import math
+
+
+class MeanState:
+    """Сливаемое состояние count/sum/mean"""
+
+    def __init__(self, total=0.0, count=0):
+        self.total = total
+        self.count = count
+
+    def add(self, value, weight=1):
+        self.total += value * weight
+        self.count += weight
+        return self
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class TDigest:
+    """Сливаемый скетч квантилей (merging t-digest, масштабная функция k1).
+
+    Хранит не больше ~compression центроидов (среднее, вес) независимо от объёма данных.
+    Скетчи шардов/дней сливаются через merge(), медиана берётся quantile(0.5)
+    с ограниченной ошибкой по рангу; пока все центроиды единичного веса,
+    результат совпадает с PERCENTILE_CONT.
+    """
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.centroids = []  # [(mean, weight)] по возрастанию mean
+        self.pending = []
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value, weight=1):
+        if value is None or weight <= 0 or (isinstance(value, float) and math.isnan(value)):
+            return self
+        self.pending.append((float(value), float(weight)))
+        self.total += weight
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.pending) > 5 * self.compression:
+            self._compress()
+        return self
+
+    def merge(self, other):
+        other._compress()
+        for mean, weight in other.centroids:
+            self.pending.append((mean, weight))
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        self._compress()
+        return self
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def _compress(self):
+        if not self.pending:
+            return
+        points = sorted(self.centroids + self.pending)
+        self.pending = []
+        total = sum(weight for _, weight in points)
+        merged = []
+        cur_mean, cur_weight = points[0]
+        weight_before = 0.0
+        for mean, weight in points[1:]:
+            q_left = weight_before / total
+            q_right = (weight_before + cur_weight + weight) / total
+            if self._k(q_right) - self._k(q_left) <= 1:
+                cur_mean += (mean - cur_mean) * weight / (cur_weight + weight)
+                cur_weight += weight
+            else:
+                merged.append((cur_mean, cur_weight))
+                weight_before += cur_weight
+                cur_mean, cur_weight = mean, weight
+        merged.append((cur_mean, cur_weight))
+        self.centroids = merged
+
+    def quantile(self, q):
+        """Квантиль q в [0, 1] (интерполяция между центрами центроидов)"""
+        self._compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+
+        # Позиция как у PERCENTILE_CONT: q * (n - 1) по центрам единичных центроидов
+        target = q * (self.total - 1) + 0.5
+        centers = []
+        cumulative = 0.0
+        for mean, weight in self.centroids:
+            centers.append(cumulative + weight / 2)
+            cumulative += weight
+
+        if target <= centers[0]:
+            low, high = self.min, self.centroids[0][0]
+            span = centers[0]
+            return low + (high - low) * (target / span if span else 0)
+        if target >= centers[-1]:
+            low, high = self.centroids[-1][0], self.max
+            span = self.total - centers[-1]
+            return low + (high - low) * ((target - centers[-1]) / span if span else 0)
+        for i in range(len(centers) - 1):
+            if centers[i] <= target <= centers[i + 1]:
+                low, high = self.centroids[i][0], self.centroids[i + 1][0]
+                return low + (high - low) * (target - centers[i]) / (centers[i + 1] - centers[i])
+        return self.centroids[-1][0]
@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import re
+import threading
+from datetime import date, datetime
+import pandas as pd
+import config
+import database
+import parallel_executor
+import sheets_gate
+from rollup_store import RollupStore
+
+try:
+    import asyncpg
+except ImportError:  # асинхронный режим необязателен
+    asyncpg = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+SHEETS_API_URL = 'https://sheets.googleapis.com/v4/spreadsheets/'
+
+# Именованный параметр SQLAlchemy (:name), но не приведение типа (::type) и не время ('00:01:00')
+PARAM_PATTERN = re.compile(r'(?<![:\w]):([A-Za-z_]\w*)')
+
+_token_lock = threading.Lock()
+
+
+def async_settings():
+    return getattr(config, 'ASYNC_EXECUTION', {})
+
+def is_enabled():
+    """Асинхронный режим включён в config.ASYNC_EXECUTION и asyncpg/aiohttp установлены"""
+    if not async_settings().get('enabled', False):
+        return False
+    if asyncpg is None or aiohttp is None:
+        logger.warning("Асинхронный режим требует asyncpg и aiohttp, используется обычный (потоковый) режим")
+        return False
+    return True
+
+def to_asyncpg(query, params):
+    """SQL с именованными параметрами (:name) -> SQL asyncpg ($1, $2, ...) и список значений"""
+    params = params or {}
+    order = []
+
+    def replace(match):
+        name = match.group(1)
+        if name not in params:
+            return match.group(0)
+        if name not in order:
+            order.append(name)
+        return f"${order.index(name) + 1}"
+
+    return PARAM_PATTERN.sub(replace, query), [params[name] for name in order]
+
+def coerce_arguments(parameters, args):
+    """Строковые даты -> datetime/date по типам параметров подготовленного запроса.
+
+    psycopg2 передаёт строки литералами и приводит их сервер, asyncpg требует значения нужного типа.
+    """
+    values = []
+    for parameter, value in zip(parameters, args):
+        if isinstance(value, str) and parameter.name in ('timestamp', 'timestamptz'):
+            value = datetime.fromisoformat(value)
+        elif isinstance(value, str) and parameter.name == 'date':
+            value = date.fromisoformat(value[:10])
+        values.append(value)
+    return values
+
+async def create_pool():
+    """Пул asyncpg по config.DB_CONFIG (отдельный от пула SQLAlchemy)"""
+    pool_config = getattr(config, 'DB_POOL', {})
+    size = async_settings().get('db_concurrency', 10)
+    return await asyncpg.create_pool(
+        host=config.DB_CONFIG['host'],
+        port=int(config.DB_CONFIG['port']),
+        database=config.DB_CONFIG['database'],
+        user=config.DB_CONFIG['user'],
+        password=config.DB_CONFIG['password'],
+        min_size=1,
+        max_size=size,
+        timeout=pool_config.get('connect_timeout', 10),
+        server_settings={'application_name': pool_config.get('application_name', 'kpi_automation')},
+    )
+
+async def fetch_frame(pool, semaphore, query, params=None, query_name="Unknown", cache=None, timeout=None,
+                      raise_errors=False):
+    """Асинхронный аналог database.execute_query: DataFrame с теми же типами, что дал бы read_sql.
+
+    По истечении timeout asyncpg отменяет запрос на сервере, выбрасывается QueryTimeoutError;
+    прочие ошибки дают пустой DataFrame или, с raise_errors, пробрасываются.
+    """
+    cache_key = None
+    if cache is not None and cache.accepts(params):
+        cache_key = cache.key(query_name, query, params)
+        df = await asyncio.to_thread(cache.get, query_name, cache_key)
+        if df is not None:
+            logger.info(f"Запрос {query_name} взят из кэша. Получено {len(df)} строк")
+            return df
+
+    sql, args = to_asyncpg(query, params)
+    try:
+        async with semaphore:
+            logger.info(f"Выполняем запрос: {query_name}")
+            async with pool.acquire() as connection:
+                statement = await connection.prepare(sql)
+                columns = [attribute.name for attribute in statement.get_attributes()]
+                rows = await statement.fetch(*coerce_arguments(statement.get_parameters(), args), timeout=timeout)
+    except asyncio.TimeoutError as e:
+        logger.error(f"Запрос {query_name} прерван: превышен таймаут {timeout} с")
+        raise database.QueryTimeoutError([query_name], timeout) from e
+    except Exception as e:
+        logger.error(f"Ошибка выполнения запроса {query_name}: {e}")
+        if raise_errors:
+            raise
+        return pd.DataFrame()
+
+    df = pd.DataFrame([[database.native_value(value) for value in row] for row in rows], columns=columns)
+    logger.info(f"Запрос {query_name} выполнен. Получено {len(df)} строк")
+    if df.empty:
+        logger.warning(f"Запрос {query_name} вернул пустой результат")
+    if cache_key is not None:
+        await asyncio.to_thread(cache.put, query_name, cache_key, df)
+    return df
+
+async def gather_frames(coroutines):
+    """Результаты корутин по порядку; таймаут любой из них выбрасывается после завершения остальных"""
+    outcomes = await asyncio.gather(*coroutines, return_exceptions=True)
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            raise outcome
+    return outcomes
+
+async def run_query(pool, semaphore, name, query, params, spec, cache=None, rollups=None):
+    """Запрос из SQL_QUERIES: шардируемые (spec['shard']) выполняются подпериодами и объединяются
+    как в parallel_executor, дневные шарды берутся из хранилища агрегатов и сохраняются в него"""
+    timeout = database.query_timeout(spec)
+    shards = parallel_executor.plan_shards(name, query, params, spec)
+    if not shards:
+        return await fetch_frame(pool, semaphore, query, params, name, cache, timeout)
+
+    version = RollupStore.version(spec.get('shard_query', query)) if rollups is not None and spec.get('shard') == 'day' else None
+
+    async def shard_frame(shard_name, shard_query, shard_params):
+        day = parallel_executor.shard_day(shard_name)
+        stored = rollups.get(name, day, version) if version else None
+        if stored is not None:
+            return stored
+        df = await fetch_frame(pool, semaphore, shard_query, shard_params, shard_name, cache, timeout,
+                               raise_errors=True)
+        if version:
+            rollups.put(name, day, version, df)
+        return df
+
+    logger.info(f"Запрос {name} разбит на {len(shards)} шардов")
+    try:
+        frames = await gather_frames([shard_frame(*shard) for shard in shards])
+    except database.QueryTimeoutError:
+        raise
+    except Exception as e:
+        # Шард с ошибкой: значение за период было бы неполным, запрос учитывается как прерванный
+        logger.error(f"Шард запроса {name} завершился ошибкой: {e}")
+        raise database.QueryTimeoutError([name], timeout) from e
+    return parallel_executor.merge_shards(name, frames, spec)
+
+async def run_days(pool, semaphore, name, day_query, cache=None, rollups=None):
+    """Запрос по дням (CUSTODY DEPOSITS): дни выполняются конкурентно, результат — day_query['combine'](дни, {день: DataFrame})"""
+    query = day_query['query']
+    version = RollupStore.version(query)
+
+    async def day_frame(day, params):
+        stored = rollups.get(name, day, version) if rollups is not None else None
+        if stored is not None:
+            return stored
+        try:
+            df = await fetch_frame(pool, semaphore, query, params, f"{day_query['label']}_{day}", cache,
+                                   day_query.get('timeout'), raise_errors=True)
+        except database.QueryTimeoutError:
+            raise
+        except Exception:
+            # День с ошибкой не сохраняется и считается днём без данных
+            return pd.DataFrame()
+        if rollups is not None:
+            rollups.put(name, day, version, df)
+        return df
+
+    days = list(day_query['params'])
+    frames = await gather_frames([day_frame(day, params) for day, params in day_query['params'].items()])
+    return day_query['combine'](days, dict(zip(days, frames)))
+
+async def run_queries(queries_with_params, query_specs=None, day_queries=None, extra_tasks=None, cache=None,
+                      rollups=None, timed_out=None):
+    """Все запросы запуска в одном цикле событий: {имя: DataFrame}.
+
+    queries_with_params — запросы SQL_QUERIES (с шардированием по query_specs);
+    day_queries — {имя: {'query', 'params': {день: параметры}, 'label', 'timeout', 'combine'}};
+    extra_tasks — синхронные задачи (потоковые таблицы, локальные KPI), выполняются в потоках
+    через asyncio.to_thread. Одновременно к БД идёт не больше ASYNC_EXECUTION['db_concurrency']
+    запросов. Запросы, прерванные по таймауту, добавляются в timed_out, их результат пустой.
+    """
+    semaphore = asyncio.Semaphore(async_settings().get('db_concurrency', 10))
+    pool = await create_pool()
+    try:
+        coroutines = {}
+        for name, (query, params) in queries_with_params.items():
+            spec = (query_specs or {}).get(name, {})
+            coroutines[name] = run_query(pool, semaphore, name, query, params, spec, cache, rollups)
+        for name, day_query in (day_queries or {}).items():
+            coroutines[name] = run_days(pool, semaphore, name, day_query, cache, rollups)
+        for name, task in (extra_tasks or {}).items():
+            coroutines[name] = asyncio.to_thread(task)
+        outcomes = await asyncio.gather(*coroutines.values(), return_exceptions=True)
+    finally:
+        await pool.close()
+
+    results = {}
+    for name, outcome in zip(coroutines, outcomes):
+        if isinstance(outcome, database.QueryTimeoutError):
+            parallel_executor.report_timeout(timed_out, [name])
+            outcome = pd.DataFrame()
+        elif isinstance(outcome, BaseException):
+            logger.error(f"Ошибка в запросе {name}: {outcome}")
+            outcome = pd.DataFrame()
+        else:
+            logger.info(f"Запрос {name} завершен")
+        results[name] = outcome
+    return results
+
+def access_token(credentials):
+    """Действующий OAuth-токен сервисного аккаунта (обновляется при истечении)"""
+    from google.auth.transport.requests import Request
+    with _token_lock:
+        if not credentials.valid:
+            credentials.refresh(Request())
+        return credentials.token
+
+async def sheets_request(session, credentials, gate, method, url, body):
+    """Запрос к Sheets API через aiohttp с квотой и повторами RequestGate"""
+    attempt = 0
+    while True:
+        spreadsheet_id, kind = await asyncio.to_thread(gate.acquire, method, url) if gate else (None, None)
+        token = await asyncio.to_thread(access_token, credentials)
+        async with session.request(method, url, json=body, headers={'Authorization': f"Bearer {token}"}) as response:
+            if response.status < 400:
+                return await response.json()
+            text = await response.text()
+            delay = (gate.retry_delay(spreadsheet_id, kind, response.status, attempt,
+                                      sheets_gate.is_idempotent(method, url)) if gate else None)
+            if delay is None:
+                raise RuntimeError(f"Sheets API {response.status}: {text[:500]}")
+        attempt += 1
+        await asyncio.sleep(delay)
+
+async def flush_spreadsheet(session, semaphore, plan, spreadsheet_id, credentials, gate=None):
+    """Запросы плана одной таблицы по порядку (batchUpdate, очистка, значения)"""
+    plan.log_spreadsheet(spreadsheet_id)
+    if config.SHEETS_DEBUG.get('dry_run'):
+        return True
+    try:
+        async with semaphore:
+            for method, body in plan.calls(spreadsheet_id):
+                await sheets_request(session, credentials, gate, 'POST', f"{SHEETS_API_URL}{spreadsheet_id}{method}", body)
+                plan.mark_flushed(spreadsheet_id, method)
+        plan.mark_flushed(spreadsheet_id)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка пакетной записи в таблицу {spreadsheet_id}: {e}")
+        return False
+
+async def flush_plan(plan, client, gate=None):
+    """Асинхронный аналог WritePlan.flush: таблицы отправляются конкурентно
+    (не больше ASYNC_EXECUTION['sheets_concurrency']), запросы одной таблицы — по порядку"""
+    if not plan.entries and not plan.clears and not plan.requests:
+        logger.info("План записи пуст")
+        return True
+    credentials = getattr(getattr(client, 'http_client', client), 'auth', None)  # gspread 6 / gspread 5
+    semaphore = asyncio.Semaphore(async_settings().get('sheets_concurrency', 2))
+    async with aiohttp.ClientSession() as session:
+        outcomes = await asyncio.gather(*(flush_spreadsheet(session, semaphore, plan, spreadsheet_id, credentials, gate)
+                                          for spreadsheet_id in list(plan.spreadsheets)))
+    plan.reset()
+    return all(outcomes)
@@ -2,20 +2,30 @@ import pandas as pd
 import gspread
 from google.oauth2.service_account import Credentials
 from datetime import datetime, timedelta
+import argparse
+import asyncio
+import json
 import logging
 from logging.handlers import RotatingFileHandler
 import time
+import concurrent.futures
+from functools import partial
 from typing import Dict, Any
 import config
-import config_placement
 import data_processing
 import database
 import parallel_executor
+import async_executor
 import sheet_placement
+import placement_runner
+import sheet_batch
+import sheets_gate
+import result_cache
+import query_fusion
+from rollup_store import RollupStore
+from query_history import QueryHistory
 import query_config
 import debug_utils  # Новый импорт
-from data_processing import process_common_kpi, extract_single_value, process_statuses_data
-from sheet_placement import update_sheet_precise
 
 def setup_logging():
     """Настройка логирования"""
@@ -56,81 +66,163 @@ def get_week_dates() -> Dict[str, Any]:
     if config.DEBUG_MODE:
         return debug_utils.get_test_dates()
     
+    dates = latest_week()
+    
+    logger.info(f"Даты обработки: {dates['start_week']} - {dates['end_week']}")
+    logger.info(f"Исключающая дата для SQL: {dates['end_week_exclusive']}")
+    logger.info(f"Неделя №{dates['week_number']}, {dates['year']} год")
+    
+    return dates
+
+def week_dates(monday):
+    """Даты недели, начинающейся в понедельник monday, в формате get_week_dates"""
+    monday = datetime(monday.year, monday.month, monday.day)
+    sunday = monday + timedelta(days=6)
+    return {
+        'start_week': monday.strftime('%Y-%m-%d'),
+        'end_week': sunday.strftime('%Y-%m-%d'),
+        'end_week_exclusive': (sunday + timedelta(days=1)).strftime('%Y-%m-%d'),
+        'daily_dates': [(monday + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(7)],
+        'week_number': monday.isocalendar()[1],
+        'year': monday.year,
+        'is_test_mode': False
+    }
+
+def latest_week():
+    """Последняя закрытая неделя (Пн-Вс) — неделя обычного запуска"""
     today = datetime.now()
-    last_monday = today - timedelta(days=today.weekday() + 7)
-    last_sunday = last_monday + timedelta(days=6)
-    end_week_exclusive = last_sunday + timedelta(days=1)
-        
-        dates = {
-            'start_week': last_monday.strftime('%Y-%m-%d'),
-            'end_week': last_sunday.strftime('%Y-%m-%d'),
-            'end_week_exclusive': end_week_exclusive.strftime('%Y-%m-%d'),
-            'daily_dates': [(last_monday + timedelta(days=i)).strftime('%Y-%m-%d') 
-                           for i in range(7)],
-            'week_number': last_monday.isocalendar()[1],
-            'year': last_monday.year,
-            'is_test_mode': False
-        }
-        
-        logger.info(f"Даты обработки: {dates['start_week']} - {dates['end_week']}")
-        logger.info(f"Исключающая дата для SQL: {dates['end_week_exclusive']}")
-        logger.info(f"Неделя №{dates['week_number']}, {dates['year']} год")
-        
-        return dates
+    return week_dates(today - timedelta(days=today.weekday() + 7))
+
+def backfill_weeks(date_from, date_to):
+    """Недели (Пн-Вс) от недели, содержащей date_from, до недели, содержащей date_to, — только закрытые"""
+    start = datetime.strptime(date_from, '%Y-%m-%d')
+    end = datetime.strptime(date_to, '%Y-%m-%d')
+    if start > end:
+        raise ValueError("Начальная дата не может быть больше конечной")
+    monday = start - timedelta(days=start.weekday())
+    current_monday = datetime.now() - timedelta(days=datetime.now().weekday())
+    weeks = []
+    while monday <= end and monday + timedelta(days=7) <= current_monday:
+        weeks.append(week_dates(monday))
+        monday += timedelta(days=7)
+    return weeks
 
 @log_execution_time
-def get_google_sheet_client():
-    """Создание клиента для работы с Google Sheets"""
+def get_google_sheet_client(gate=None):
+    """Создание клиента для работы с Google Sheets.
+
+    Если передан gate (sheets_gate.RequestGate), все запросы клиента идут через него.
+    """
     try:
         logger.info("Подключаемся к Google Sheets API")
         scopes = ["https://www.googleapis.com/auth/spreadsheets"]
         creds = Credentials.from_service_account_file(config.SERVICE_ACCOUNT_FILE, scopes=scopes)
         client = gspread.authorize(creds)
+        if gate is not None:
+            sheets_gate.install(client, gate)
         logger.info("Успешное подключение к Google Sheets")
         return client
     except Exception as e:
         logger.error(f"Ошибка подключения к Google Sheets: {e}")
         return None
 
+def check_sheets_client(client):
+    """Проверка клиента Sheets долгоживущего процесса: истёкший токен сервисного аккаунта обновляется.
+
+    False — обновить токен не удалось, клиент нужно создать заново.
+    """
+    from google.auth.transport.requests import Request
+    credentials = getattr(getattr(client, 'http_client', client), 'auth', None)  # gspread 6 / gspread 5
+    try:
+        if credentials is not None and not credentials.valid:
+            credentials.refresh(Request())
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось обновить токен Google Sheets: {e}")
+        return False
+
+CUSTODY_DEPOSITS_QUERY = """
+    select date(registered_at), avg(duration_sending_at) as avg_duration_sending, count(*) from (
+        SELECT distinct o.external_id, s.registered_at, es2.sending_at, s.registered_at - es2.sending_at as duration_sending_at
+        FROM fincore.splits s
+          INNER JOIN fincore.transactions t ON t.id = s.transaction_id
+          INNER JOIN fincore.operations o ON o.id = t.operation_id
+          INNER JOIN LATERAL (
+            SELECT e.id, to_timestamp(((sc->>'changedAt')::jsonb ->> '$date')::bigint / 1000) AS sending_at FROM exchanger.exchanges_cashed e, 
+            json_array_elements(array_to_json(e.status_change)) sc 
+            WHERE e.id = o.external_id AND sc->>'to' = 'sending'
+            and e.created_at between :day and :next_day) es2 ON es2.id = o.external_id
+          INNER JOIN exchanger.exchanges_cashed e1 ON e1.id = o.external_id
+        WHERE s.account_id IN (SELECT id FROM fincore.accounts pa WHERE "account_type" = 'LIABILITY')
+          AND o."operation_type" = 'EXCHANGE' and t.external_id like 'PO:c%'
+          AND e1.payout::text like '%changenow_partner%' 
+          and t.created_at between :day and :next_day
+          and o.created_at between :day and :next_day
+          and s.created_at between :day and :next_day
+         and lower(t.external_id) not like '%fee%'
+    ) subq1 
+    group by 1;
+"""
+
+def run_custody_day(engine, day, cache=None, rollups=None):
+    """CUSTODY PARTNER DEPOSITS за один день (из хранилища дневных агрегатов, если день уже сохранён)"""
+    version = RollupStore.version(CUSTODY_DEPOSITS_QUERY)
+    if rollups is not None:
+        stored = rollups.get('custody_deposits', day, version)
+        if stored is not None:
+            return stored
+    next_day = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    timeout = getattr(config, 'EXECUTION_SETTINGS', {}).get('custody_timeout')
+    # Ошибка пробрасывается: пустой результат сохраняется в хранилище как посчитанный тихий день
+    df = database.execute_query(engine, CUSTODY_DEPOSITS_QUERY, {'day': day, 'next_day': next_day},
+                                f"CUSTODY_PARTNER_DEPOSITS_{day}", cache, timeout, raise_errors=True)
+    if rollups is not None:
+        rollups.put('custody_deposits', day, version, df)
+    return df
+
 @log_execution_time
-def run_custody_partner_deposits(engine, dates):
-    """Расчет среднего времени CUSTODY PARTNER DEPOSITS за период"""
+def run_custody_partner_deposits(engine, dates, cache=None, rollups=None):
+    """Расчет среднего времени CUSTODY PARTNER DEPOSITS за период.
+
+    Дни выполняются параллельно (EXECUTION_SETTINGS['custody_workers']) через общий пул
+    соединений движка; средневзвешенное считается после всех дней в порядке дат,
+    поэтому результат совпадает с последовательным расчётом.
+    Если запрос хотя бы одного дня прерван по таймауту (EXECUTION_SETTINGS['custody_timeout']),
+    после остальных дней выбрасывается QueryTimeoutError: неполное среднее не размещается.
+    """
     if config.DEBUG_MODE and config.DEBUG_SETTINGS['skip_slow_queries']:
         logger.info("Пропускаем CUSTODY DEPOSITS в тестовом режиме")
         return pd.DataFrame()
     
     logger.info("Начинаем обработку CUSTODY PARTNER DEPOSITS AVG TIME")
-    daily_results = []
+    days = dates['daily_dates']
+    workers = max(1, getattr(config, 'EXECUTION_SETTINGS', {}).get('custody_workers', 1))
     
-    for i, day in enumerate(dates['daily_dates']):
-        logger.info(f"Обрабатываем день {i+1}/{len(dates['daily_dates'])}: {day}")
-        next_day = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
-        
-        query = """
-            select date(registered_at), avg(duration_sending_at) as avg_duration_sending, count(*) from (
-                SELECT distinct o.external_id, s.registered_at, es2.sending_at, s.registered_at - es2.sending_at as duration_sending_at
-                FROM fincore.splits s
-                  INNER JOIN fincore.transactions t ON t.id = s.transaction_id
-                  INNER JOIN fincore.operations o ON o.id = t.operation_id
-                  INNER JOIN LATERAL (
-                    SELECT e.id, to_timestamp(((sc->>'changedAt')::jsonb ->> '$date')::bigint / 1000) AS sending_at FROM exchanger.exchanges_cashed e, 
-                    json_array_elements(array_to_json(e.status_change)) sc 
-                    WHERE e.id = o.external_id AND sc->>'to' = 'sending'
-                    and e.created_at between :day and :next_day) es2 ON es2.id = o.external_id
-                  INNER JOIN exchanger.exchanges_cashed e1 ON e1.id = o.external_id
-                WHERE s.account_id IN (SELECT id FROM fincore.accounts pa WHERE "account_type" = 'LIABILITY')
-                  AND o."operation_type" = 'EXCHANGE' and t.external_id like 'PO:c%'
-                  AND e1.payout::text like '%changenow_partner%' 
-                  and t.created_at between :day and :next_day
-                  and o.created_at between :day and :next_day
-                  and s.created_at between :day and :next_day
-                 and lower(t.external_id) not like '%fee%'
-            ) subq1 
-            group by 1;
-        """
-        
-        df_day = database.execute_query(engine, query, {'day': day, 'next_day': next_day}, 
-                              f"CUSTODY_PARTNER_DEPOSITS_{day}")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(days)) or 1) as executor:
+        future_to_day = {executor.submit(run_custody_day, engine, day, cache, rollups): day for day in days}
+        day_results = {}
+        timed_out_days = []
+        for future in concurrent.futures.as_completed(future_to_day):
+            day = future_to_day[future]
+            try:
+                day_results[day] = future.result()
+            except database.QueryTimeoutError:
+                timed_out_days.append(day)
+                day_results[day] = pd.DataFrame()
+            except Exception as e:
+                logger.error(f"Ошибка обработки дня {day}: {e}")
+                day_results[day] = pd.DataFrame()
+            logger.info(f"Обработан день {len(day_results)}/{len(days)}: {day}")
+    if timed_out_days:
+        logger.error(f"CUSTODY DEPOSITS: прерваны по таймауту дни {', '.join(sorted(timed_out_days))}")
+        raise database.QueryTimeoutError(['custody_deposits'], getattr(config, 'EXECUTION_SETTINGS', {}).get('custody_timeout'))
+    return combine_custody_days(days, day_results)
+
+def combine_custody_days(days, day_results):
+    """Средневзвешенное время CUSTODY DEPOSITS за период из результатов дней {день: DataFrame}"""
+    daily_results = []
+    for day in days:
+        df_day = day_results[day]
         if not df_day.empty:
             daily_results.append(df_day)
             logger.info(f"Данные за {day}: avg_duration_sending={df_day['avg_duration_sending'].iloc[0]}, count={df_day['count'].iloc[0]}")
@@ -162,98 +254,462 @@ def run_custody_partner_deposits(engine, dates):
     logger.warning("Нет данных за весь период")
     return pd.DataFrame()
 
+# Запросы, из результата которых размещаются одиночные значения (одна строка)
+SCALAR_QUERIES = (
+    'tf_sr_payouts',
+    'tf_sr_partner_liability',
+    'tf_sr_median_payouts',
+    'tf_sr_submitted_to_finished',
+    'sr_payouts_slow',
+)
+
+def stream_table_query(engine, session, query_name, query, params, chunksize, timed_out=None):
+    """Потоковый запрос: чанки серверного курсора сразу вставляются в лист (data_type 'table').
+
+    Возвращает пустой DataFrame (размещение уже выполнено) с числом строк в attrs['streamed_rows'].
+    Таймаут или ошибка посреди потока оставляют лист обновлённым частично, поэтому запрос
+    добавляется в timed_out и попадает в отчёт о частичном запуске. Размещение учитывается
+    в сводке сессии (session.record), как размещения PlacementRunner.
+    """
+    timeout = database.query_timeout(query_config.SQL_QUERIES.get(query_name))
+    chunks = database.iter_query_chunks(engine, query, params, query_name, chunksize, timeout)
+    result = pd.DataFrame()
+    try:
+        rows = sheet_placement.update_table_chunks(session, chunks, query_name)
+    except database.QueryTimeoutError:
+        parallel_executor.report_timeout(timed_out, [query_name])
+        session.record(query_name, False)
+        return result
+    except Exception as e:
+        logger.error(f"Ошибка потоковой вставки {query_name}: {e}")
+        parallel_executor.report_timeout(timed_out, [query_name], "из-за ошибки потокового запроса")
+        session.record(query_name, False)
+        return result
+    result.attrs['streamed_rows'] = rows
+    if rows:
+        session.record(query_name, True)
+    return result
+
+def group_local_queries(queries_to_execute):
+    """{выгрузка: [запросы]} для запросов с объявлением 'local', выгрузка которых описана в RAW_EXTRACTS"""
+    extracts = getattr(query_config, 'RAW_EXTRACTS', {})
+    groups = {}
+    for name in queries_to_execute:
+        local = query_config.SQL_QUERIES.get(name, {}).get('local')
+        if local and local['extract'] in extracts:
+            groups.setdefault(local['extract'], []).append(name)
+    return groups
+
+def run_local_metrics(engine, extract_name, names, dates, cache=None):
+    """Одна сырая выгрузка за период и локальный расчёт всех KPI, объявивших её в 'local'.
+
+    Возвращает {имя запроса: DataFrame} в тех же колонках, что и SQL-версии запросов.
+    Если выгрузка пуста (в т.ч. из-за ошибки), KPI не считаются, чтобы не записать нули.
+    """
+    extract = query_config.RAW_EXTRACTS[extract_name]
+    raw = database.execute_query(engine, extract['query'], build_query_params(extract, dates),
+                                 f"extract:{extract_name}", cache, database.query_timeout(extract))
+    if raw.empty:
+        logger.warning(f"Выгрузка {extract_name} пуста, локальные KPI {', '.join(names)} не рассчитаны")
+        return {}
+    results = {}
+    for name in names:
+        results[name] = data_processing.compute_local_metrics(
+            raw, query_config.SQL_QUERIES[name]['local'], dates['start_week'], dates['end_week_exclusive'])
+        logger.info(f"Локальный расчёт {name}: {len(results[name])} строк")
+    return results
+
+def run_streaming_pipeline(engine, queries_to_execute, extra_tasks, runner, cache=None, rollups=None,
+                           scalar_queries=(), batch_scalars=False, query_specs=None, fused=None, history=None,
+                           timed_out=None):
+    """Потоковый режим: каждый результат передаётся писателю своей таблицы сразу после завершения запроса"""
+    results = {}
+    runner.start()
+    try:
+        pairs = parallel_executor.iter_parallel_queries(engine, queries_to_execute, config.MAX_WORKERS, extra_tasks,
+                                                        query_specs or query_config.SQL_QUERIES, cache, rollups,
+                                                        scalar_queries, batch_scalars, history, timed_out)
+        for query_name, df in query_fusion.fan_out(pairs, fused or {}):
+            results[query_name] = df
+            runner.submit(query_name, df)
+    finally:
+        runner.join()
+    return results
+
+def custody_day_queries(dates):
+    """CUSTODY DEPOSITS для асинхронного режима: запрос по дням периода и сборка средневзвешенного"""
+    params = {}
+    for day in dates['daily_dates']:
+        next_day = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+        params[day] = {'day': day, 'next_day': next_day}
+    return {
+        'query': CUSTODY_DEPOSITS_QUERY,
+        'params': params,
+        'label': 'CUSTODY_PARTNER_DEPOSITS',
+        'timeout': getattr(config, 'EXECUTION_SETTINGS', {}).get('custody_timeout'),
+        'combine': combine_custody_days,
+    }
+
+def write_partial_report(dates, timed_out, fused=None):
+    """Список KPI, не размещённых из-за таймаута, в лог и в файл EXECUTION_SETTINGS['partial_report'].
+
+    Файл перезаписывается каждым запуском (пустой список — запуск полный), объединённые
+    задачи раскрываются в имена исходных запросов.
+    """
+    names = []
+    for name in timed_out:
+        names.extend((fused or {}).get(name, [name]))
+    if names:
+        logger.error(f"Частичный запуск: по таймауту или из-за ошибки не размещены {', '.join(names)}")
+    path = getattr(config, 'EXECUTION_SETTINGS', {}).get('partial_report')
+    if not path:
+        return
+    report = {
+        'period': {'start': dates['start_week'], 'end': dates['end_week']},
+        'finished_at': datetime.now().isoformat(timespec='seconds'),
+        'partial': bool(names),
+        'timed_out': names,
+    }
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        logger.warning(f"Не удалось записать отчёт о частичном запуске {path}: {e}")
+
+def build_query_params(query_spec, dates):
+    """Подстановка дат периода вместо плейсхолдеров ':start_week', ':end_week', ':end_week_exclusive'"""
+    params = {}
+    for param_name, param_value in query_spec['params'].items():
+        if param_value == ':start_week':
+            params[param_name] = dates['start_week']
+        elif param_value == ':end_week':
+            params[param_name] = dates['end_week']
+        elif param_value == ':end_week_exclusive':
+            params[param_name] = dates['end_week_exclusive']
+        else:
+            params[param_name] = param_value
+    return params
+
 @log_execution_time
-def main():
-    """Основная функция"""
+def update_daily_rollups(day=None, engine=None):
+    """Досчитывает в хранилище дневных агрегатов один день (по умолчанию вчерашний).
+
+    Выполняются только дневные шарды запросов с 'shard': 'day' и CUSTODY DEPOSITS за этот день;
+    недельный main затем собирает период из сохранённых дней.
+    engine — движок долгоживущего процесса; если не передан, создаётся и закрывается здесь.
+    """
+    rollups = RollupStore.from_config()
+    if rollups is None:
+        logger.info("Хранилище дневных агрегатов выключено (ROLLUP_STORE['enabled'])")
+        return
+    day = day or (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    next_day = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    dates = {'start_week': day, 'end_week': day, 'end_week_exclusive': next_day, 'daily_dates': [day]}
+    logger.info(f"Обновляем дневные агрегаты за {day}")
+
+    owns_engine = engine is None
+    if owns_engine:
+        engine = database.create_db_connection()
+    if not engine:
+        logger.error("Не удалось подключиться к БД. Дневные агрегаты не обновлены.")
+        rollups.close()
+        return
+    try:
+        queries = {}
+        for query_name in query_config.PARALLEL_QUERIES:
+            spec = query_config.SQL_QUERIES.get(query_name, {})
+            if spec.get('shard') == 'day':
+                queries[query_name] = (spec['query'], build_query_params(spec, dates))
+        extra_tasks = {'custody_deposits': partial(run_custody_partner_deposits, engine, dates, None, rollups)}
+        parallel_executor.execute_parallel_queries(engine, queries, config.MAX_WORKERS, extra_tasks,
+                                                   query_config.SQL_QUERIES, rollups=rollups)
+        logger.info(f"Дневные агрегаты за {day}: сохранено {rollups.stored}, уже были {rollups.reused}")
+    finally:
+        rollups.close()
+        database.log_pool_stats(engine)
+        if owns_engine:
+            engine.dispose()
+
+# Запросы, результаты которых пишутся строкой недели (Services/TF_SR) и поэтому пересчитываются в backfill;
+# листы-снимки (status, currency) описывают только последнюю неделю и backfill не затрагивает
+BACKFILL_QUERIES = (
+    'common_kpi',
+    'tf_sr_payouts',
+    'tf_sr_partner_liability',
+    'tf_sr_submitted_to_finished',
+    'tf_sr_median_payouts',
+)
+
+def build_backfill_queries(weeks):
+    """Запросы пересчёта недель: {имя задачи: (запрос, параметры)}, {имя задачи: запрос со 'scan'}
+    и описания задач {имя задачи: описание запроса} для parallel_executor.
+
+    Запросы со 'scan' выполняются один раз за весь диапазон с GROUP BY date_trunc('week', ...)
+    (задача 'name@weeks', без шардирования); остальные — отдельной задачей на каждую неделю
+    ('name@YYYY-MM-DD') со своими 'timeout', 'shard' и 'combine'.
+    """
+    whole_range = dict(weeks[0], end_week=weeks[-1]['end_week'], end_week_exclusive=weeks[-1]['end_week_exclusive'])
+    queries = {}
+    grouped = {}
+    specs = {}
+    for query_name in BACKFILL_QUERIES:
+        spec = query_config.SQL_QUERIES.get(query_name)
+        if spec is None:
+            continue
+        if spec.get('scan'):
+            task_name = f"{query_name}@weeks"
+            queries[task_name] = (query_fusion.build_grouped_query(spec, 'week'), build_query_params(spec, whole_range))
+            grouped[task_name] = query_name
+            specs[task_name] = {'timeout': spec['timeout']} if 'timeout' in spec else {}
+            continue
+        for week in weeks:
+            task_name = f"{query_name}@{week['start_week']}"
+            queries[task_name] = (spec['query'], build_query_params(spec, week))
+            specs[task_name] = spec
+    return queries, grouped, specs
+
+def split_backfill_results(results, weeks, grouped):
+    """Результаты задач backfill по неделям: {начало недели: {имя запроса: DataFrame}}"""
+    starts = [week['start_week'] for week in weeks]
+    by_week = {start: {} for start in starts}
+    for task_name, df in results.items():
+        if task_name in grouped:
+            for start, frame in query_fusion.split_grouped_result(df, starts).items():
+                by_week[start][grouped[task_name]] = frame
+            continue
+        query_name, _, start = task_name.rpartition('@')
+        if start not in by_week:
+            continue
+        by_week[start][query_name] = df
+    return by_week
+
+@log_execution_time
+def run_backfill(date_from, date_to, engine=None, cache_mode=None, clear_cache=False):
+    """Пересчёт KPI за несколько недель [date_from, date_to] одним запуском.
+
+    Один движок и один клиент Sheets на весь диапазон; запросы всех недель выполняются в одном
+    пуле (запросы со 'scan' — одним GROUP BY по неделям), CUSTODY DEPOSITS — по неделям с общими
+    дневными агрегатами. Неделя, уже подписанная на листах Services/TF_SR, перезаписывается
+    в своей строке, недостающие недели добавляются после занятых строк; всё отправляется одним
+    пакетным планом записи. Ссылки листа status обновляются, только если диапазон включает
+    последнюю закрытую неделю. clear_cache — удалить все записи кэша перед запуском.
+    """
+    weeks = backfill_weeks(date_from, date_to)
+    if not weeks:
+        logger.error(f"В диапазоне {date_from} - {date_to} нет закрытых недель")
+        return {}
+    logger.info(f"Backfill: {len(weeks)} недель, {weeks[0]['start_week']} - {weeks[-1]['end_week']}")
+
+    owns_engine = engine is None
+    if owns_engine:
+        engine = database.create_db_connection()
+    if not engine:
+        logger.error("Не удалось подключиться к БД. Backfill остановлен.")
+        return {}
+    try:
+        gate = sheets_gate.RequestGate.from_config()
+        client = get_google_sheet_client(gate)
+        if not client:
+            logger.error("Не удалось подключиться к Google Sheets. Backfill остановлен.")
+            return {}
+        cache = result_cache.ResultCache.from_config(cache_mode)
+        if clear_cache:
+            cache.invalidate()
+        rollups = RollupStore.from_config()
+        try:
+            timed_out = []
+            queries, grouped, specs = build_backfill_queries(weeks)
+            extra_tasks = {f"custody_deposits@{week['start_week']}": partial(run_custody_partner_deposits, engine, week, cache, rollups)
+                           for week in weeks}
+            results = parallel_executor.execute_parallel_queries(engine, queries, config.MAX_WORKERS, extra_tasks,
+                                                                 query_specs=specs, cache=cache, rollups=rollups,
+                                                                 timed_out=timed_out)
+            by_week = split_backfill_results(results, weeks, grouped)
+
+            plan = sheet_batch.WritePlan()
+            session = sheet_placement.PlacementSession(client, plan)
+            runner = placement_runner.PlacementRunner(session)
+            for week in weeks:
+                # Неделя, уже подписанная на листе, перезаписывается в своей строке, новая — добавляется
+                session.start_week(week)
+                runner.place_all(by_week[week['start_week']])
+            # Ссылки листа status указывают на текущую (последнюю закрытую) неделю листа
+            if weeks[-1]['start_week'] == latest_week()['start_week']:
+                runner.place_dependent()
+            else:
+                logger.info("Backfill: последняя закрытая неделя не в диапазоне, ссылки листа status не меняются")
+
+            logger.info(f"Backfill: отправляем план записи, {len(plan)} диапазонов")
+            if not plan.flush():
+                logger.error("Часть пакетной записи backfill в Google Sheets завершилась ошибкой")
+            write_partial_report(dict(weeks[0], end_week=weeks[-1]['end_week']), timed_out)
+            session.log_summary()
+            gate.log_summary()
+            return by_week
+        finally:
+            if rollups is not None:
+                logger.info(f"Дневные агрегаты: взято из хранилища {rollups.reused}, сохранено {rollups.stored}")
+                rollups.close()
+    finally:
+        database.log_pool_stats(engine)
+        if owns_engine:
+            engine.dispose()
+
+@log_execution_time
+def main(cache_mode=None, clear_cache=False, engine=None, client=None, gate=None):
+    """Основная функция.
+
+    cache_mode — режим кэша результатов ('use', 'refresh', 'bypass'), по умолчанию из config;
+    clear_cache — удалить все записи кэша перед запуском;
+    engine — движок долгоживущего процесса (пул соединений переиспользуется между запусками);
+    если не передан, создаётся на запуск и закрывается в конце.
+    client, gate — авторизованный клиент Sheets долгоживущего процесса и установленный в него
+    шлюз (sheets_gate.install); счётчики шлюза сбрасываются в начале запуска. Клиент можно
+    передать и без шлюза — тогда квота не учитывается и сводка шлюза не пишется.
+    Возвращает результаты запросов или None, если запуск не состоялся или прерван ошибкой.
+    В асинхронном режиме (config.ASYNC_EXECUTION) запросы и запись плана в Sheets идут через
+    один цикл событий на запуск (async_executor).
+    """
     logger.info("Запуск процесса обновления KPI")
     
     # Настройка тестового окружения
     if config.DEBUG_MODE:
         debug_utils.setup_test_environment()
     
+    owns_engine = engine is None
+    loop = asyncio.new_event_loop() if async_executor.is_enabled() else None
     try:
         # Получаем даты
         dates = get_week_dates()
         
         # Подключаемся к БД
-        engine = database.create_db_connection()
+        if owns_engine:
+            engine = database.create_db_connection()
         if not engine:
             logger.error("Не удалось подключиться к БД. Процесс остановлен.")
             return
         
-        # Подключаемся к Google Sheets
-        client = get_google_sheet_client()
+        # Подключаемся к Google Sheets: все запросы идут через общий шлюз с учётом квоты
+        if client is None:
+            gate = sheets_gate.RequestGate.from_config()
+            client = get_google_sheet_client(gate)
+        elif gate is not None:
+            gate.reset()
         if not client:
             logger.error("Не удалось подключиться к Google Sheets. Процесс остановлен.")
             return
         
+        # Кэш результатов закрытых периодов на диске
+        cache = result_cache.ResultCache.from_config(cache_mode)
+        if clear_cache:
+            cache.invalidate()
+
+        # Дневные агрегаты шардируемых запросов (None, если хранилище выключено)
+        rollups = RollupStore.from_config()
+        # История длительностей запросов для порядка longest-job-first (None, если выключена)
+        history = QueryHistory.from_config()
+        # Запросы, прерванные по таймауту: их KPI не размещаются, остальные — как обычно
+        timed_out = []
+
         queries_to_execute = {}
         for query_name in query_config.PARALLEL_QUERIES:
             if query_name in query_config.SQL_QUERIES:
                 query_config_data = query_config.SQL_QUERIES[query_name]
-                query = query_config_data['query']
-                params = {}
-                for param_name, param_value in query_config_data['params'].items():
-                    if param_value == ':start_week':
-                        params[param_name] = dates['start_week']
-                    elif param_value == ':end_week':
-                        params[param_name] = dates['end_week']
-                    elif param_value == ':end_week_exclusive':
-                        params[param_name] = dates['end_week_exclusive']
-                    else:
-                        params[param_name] = param_value
-                queries_to_execute[query_name] = (query, params)
+                queries_to_execute[query_name] = (query_config_data['query'], build_query_params(query_config_data, dates))
         
         if config.DEBUG_MODE:
             queries_to_execute = debug_utils.get_test_queries(queries_to_execute)
         
-        results = parallel_executor.execute_parallel_queries(engine, queries_to_execute, config.MAX_WORKERS)
-        
+        # Все записи в Sheets копятся в плане и уходят одним batchUpdate на таблицу
+        plan = sheet_batch.WritePlan() if getattr(config, 'SHEETS_SETTINGS', {}).get('batch_writes', True) else None
+        # Контекст размещения запуска: таблицы и листы открываются один раз, нужные столбцы
+        # читаются в зеркало, строка недели на листах Services/TF_SR выбирается заново
+        session = sheet_placement.PlacementSession(client, plan, dates)
+        runner = placement_runner.PlacementRunner(session)
+
+        extra_tasks = {}
         if not (config.DEBUG_MODE and config.DEBUG_SETTINGS['skip_slow_queries'] and 'custody_deposits' in queries_to_execute):
-            results['custody_deposits'] = run_custody_partner_deposits(engine, dates)
-        if 'common_kpi' in results:
-            update_sheet_precise(client, results['common_kpi'], 'common_kpi', 'common_kpi')
-        
-        if 'custody_deposits' in results and not results['custody_deposits'].empty:
-            avg_time_row = results['custody_deposits'][results['custody_deposits']['metric'] == 'avg_duration_sending_period']
-            if not avg_time_row.empty:
-                avg_time = avg_time_row['value'].iloc[0]
-                update_sheet_precise(client, None, 'custody_deposits_avg', 'avg_duration_sending_weekly', avg_time)
-        
-        if 'tf_sr_payouts' in results and not results['tf_sr_payouts'].empty:
-            for column in ['total_payouts', 'long_payouts']:
-                if column in results['tf_sr_payouts'].columns:
-                    value = extract_single_value(results['tf_sr_payouts'], column)
-                    update_sheet_precise(client, None, 'tf_sr_payouts', column, value)
-
-        if 'tf_sr_partner_liability' in results and not results['tf_sr_partner_liability'].empty:
-            for column in ['total_payouts', 'long_payouts']:
-                if column in results['tf_sr_partner_liability'].columns:
-                    value = extract_single_value(results['tf_sr_partner_liability'], column)
-                    update_sheet_precise(client, None, 'tf_sr_partner_liability', column, value)
-
-        if 'tf_sr_median_payouts' in results and not results['tf_sr_median_payouts'].empty:
-            value = extract_single_value(results['tf_sr_median_payouts'], 'median_duration')
-            update_sheet_precise(client, None, 'tf_sr_median_payouts', 'median_duration', value)
-
-        if 'tf_sr_submitted_to_finished' in results and not results['tf_sr_submitted_to_finished'].empty:
-            value = extract_single_value(results['tf_sr_submitted_to_finished'], 'avg_duration')
-            update_sheet_precise(client, None, 'tf_sr_submitted_to_finished', 'avg_duration', value)
-        
-        if 'statuses_payout_reward' in results and not results['statuses_payout_reward'].empty:
-            update_sheet_precise(client, results['statuses_payout_reward'], 'statuses_payout_reward', None)
+            extra_tasks['custody_deposits'] = partial(run_custody_partner_deposits, engine, dates, cache, rollups)
+
+        # Запросы с объявлением 'local' считаются локально по одной сырой выгрузке на источник
+        fused = {}
+        if getattr(config, 'EXECUTION_SETTINGS', {}).get('local_metrics', False):
+            for extract_name, names in group_local_queries(queries_to_execute).items():
+                for name in names:
+                    del queries_to_execute[name]
+                task_name = f"local:{extract_name}"
+                extra_tasks[task_name] = partial(run_local_metrics, engine, extract_name, names, dates, cache)
+                fused[task_name] = names
+
+        # Запросы по одной таблице и периоду (с объявлением 'scan') выполняются одним проходом
+        query_specs = query_config.SQL_QUERIES
+        if getattr(config, 'EXECUTION_SETTINGS', {}).get('fuse_scans', False):
+            queries_to_execute, query_specs, scan_groups = query_fusion.fuse_queries(queries_to_execute, query_specs)
+            fused.update(scan_groups)
+
+        # Одиночные значения читаются прямо из курсора, без DataFrame (шардируемые собираются из DataFrame шардов)
+        scalar_queries = {name for name in SCALAR_QUERIES if name in queries_to_execute
+                          and not query_specs[name].get('shard')}
+        # ... и с одинаковыми параметрами периода уходят в БД одним запросом
+        batch_scalars = getattr(config, 'EXECUTION_SETTINGS', {}).get('batch_scalar_queries', False)
+
+        # Запросы с 'chunksize' читаются серверным курсором и вставляются в лист по чанкам
+        for query_name, (query, params) in list(queries_to_execute.items()):
+            chunksize = query_config.SQL_QUERIES.get(query_name, {}).get('chunksize')
+            if chunksize:
+                del queries_to_execute[query_name]
+                extra_tasks[query_name] = partial(stream_table_query, engine, session, query_name, query, params,
+                                                  chunksize, timed_out)
 
-        if 'sr_payouts_slow' in results and not results['sr_payouts_slow'].empty:
-            value = extract_single_value(results['sr_payouts_slow'], 'long_count')
-            update_sheet_precise(client, None, 'sr_payouts_slow', 'long_count', value)
+        if loop is not None:
+            # Запросы (asyncpg) и запись в Sheets (aiohttp) в одном цикле событий
+            day_queries = {}
+            if extra_tasks.pop('custody_deposits', None) is not None:
+                day_queries['custody_deposits'] = custody_day_queries(dates)
+            results = loop.run_until_complete(async_executor.run_queries(
+                queries_to_execute, query_specs, day_queries, extra_tasks, cache, rollups, timed_out))
+            results = dict(query_fusion.fan_out(results.items(), fused))
+            runner.place_all(results)
+        elif getattr(config, 'EXECUTION_SETTINGS', {}).get('streaming_placement', True):
+            # Результаты размещаются по мере готовности запросов, Sheets I/O идёт параллельно с БД
+            results = run_streaming_pipeline(engine, queries_to_execute, extra_tasks, runner, cache, rollups,
+                                             scalar_queries, batch_scalars, query_specs, fused, history, timed_out)
+        else:
+            results = parallel_executor.execute_parallel_queries(engine, queries_to_execute, config.MAX_WORKERS,
+                                                                 query_specs=query_specs, cache=cache,
+                                                                 rollups=rollups, scalar_queries=scalar_queries,
+                                                                 batch_scalars=batch_scalars, history=history,
+                                                                 timed_out=timed_out)
+            for name, task in extra_tasks.items():
+                try:
+                    results[name] = task()
+                except database.QueryTimeoutError:
+                    parallel_executor.report_timeout(timed_out, [name])
+                    results[name] = pd.DataFrame()
+            results = dict(query_fusion.fan_out(results.items(), fused))
+            runner.place_all(results)
+
+        # Ссылки на строку TF_SR на листе status — после того, как строка недели выбрана
+        runner.place_dependent()
 
-        if 'currency_stats' in results and not results['currency_stats'].empty:
-            update_sheet_precise(client, results['currency_stats'], 'currency_stats', None)
+        if plan is not None:
+            logger.info(f"Отправляем план записи: {len(plan)} диапазонов")
+            flushed = loop.run_until_complete(async_executor.flush_plan(plan, client, gate)) if loop is not None else plan.flush()
+            if not flushed:
+                logger.error("Часть пакетной записи в Google Sheets завершилась ошибкой")
+            if config.SHEETS_DEBUG.get('verify_writes') and not config.SHEETS_DEBUG.get('dry_run'):
+                plan.verify()
 
-        if 'statuses_partner_liability' in results and not results['statuses_partner_liability'].empty:
-            update_sheet_precise(client, results['statuses_partner_liability'], 'statuses_partner_liability', None)
+        write_partial_report(dates, timed_out, fused)
 
-        update_sheet_precise(client, None, 'tf_sr_links_increment', None)
+        session.log_summary()
+        if gate is not None:
+            gate.log_summary()
+        if cache.mode != 'bypass':
+            logger.info(f"Кэш результатов: попаданий {cache.hits}, промахов {cache.misses}")
+        if rollups is not None:
+            logger.info(f"Дневные агрегаты: взято из хранилища {rollups.reused}, сохранено {rollups.stored}")
+            rollups.close()
         
         logger.info("Процесс обновления KPI завершен успешно")
         
@@ -261,15 +717,50 @@ def main():
             logger.info(f"Обработан период: {dates['start_week']} - {dates['end_week']}")
             logger.info(f"Выполнено запросов: {len(results)}")
             for query_name, result in results.items():
-                status = "Успех" if not result.empty else "Пустой результат"
-                logger.info(f"  {query_name}: {status} ({len(result)} строк)")
+                rows = (1 if result else 0) if isinstance(result, dict) else result.attrs.get('streamed_rows', len(result))
+                status = "Успех" if rows else "Пустой результат"
+                logger.info(f"  {query_name}: {status} ({rows} строк)")
+        return results
         
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
         logger.exception("Детали ошибки:")
+    finally:
+        if loop is not None:
+            loop.close()
+        if engine is not None:
+            database.log_pool_stats(engine)
+            if owns_engine:
+                engine.dispose()
+
+def parse_args(argv=None):
+    """Аргументы командной строки"""
+    parser = argparse.ArgumentParser(description="Сбор KPI из PostgreSQL и размещение в Google Sheets")
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument('--no-cache', dest='cache_mode', action='store_const', const='bypass',
+                             help="не использовать кэш результатов")
+    cache_group.add_argument('--refresh-cache', dest='cache_mode', action='store_const', const='refresh',
+                             help="выполнить все запросы заново и перезаписать кэш")
+    parser.add_argument('--clear-cache', action='store_true', help="удалить все записи кэша перед запуском")
+    parser.add_argument('--rollup-day', nargs='?', const='', metavar='YYYY-MM-DD',
+                        help="только досчитать дневные агрегаты за день (по умолчанию вчерашний)")
+    parser.add_argument('--from', dest='date_from', metavar='YYYY-MM-DD',
+                        help="backfill: пересчитать недели начиная с недели этой даты (вместе с --to)")
+    parser.add_argument('--to', dest='date_to', metavar='YYYY-MM-DD',
+                        help="backfill: последняя дата диапазона")
+    args = parser.parse_args(argv)
+    if (args.date_from is None) != (args.date_to is None):
+        parser.error("--from и --to задаются вместе")
+    return args
 
 if __name__ == "__main__":
+    args = parse_args()
     try:
-        main()
+        if args.rollup_day is not None:
+            update_daily_rollups(args.rollup_day or None)
+        elif args.date_from is not None:
+            run_backfill(args.date_from, args.date_to, cache_mode=args.cache_mode, clear_cache=args.clear_cache)
+        else:
+            main(cache_mode=args.cache_mode, clear_cache=args.clear_cache)
     finally:
         logging.shutdown()
\ No newline at end of file
@@ -25,6 +25,80 @@ SERVICE_ACCOUNT_FILE = os.getenv('GOOGLE_CREDENTIALS_FILE', 'google_credentials.
 # Parallel execution settings
 MAX_WORKERS = int(os.getenv('MAX_WORKERS', '3'))
 
+# Database connection pool (pool_size defaults to MAX_WORKERS + custody_workers)
+DB_POOL = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', '0')) or None,
+    'max_overflow': int(os.getenv('DB_POOL_MAX_OVERFLOW', '2')),
+    'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '30')),
+    'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+    'pool_pre_ping': True,
+    'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '10')),
+    'application_name': os.getenv('DB_APPLICATION_NAME', 'kpi_automation'),
+}
+
+# Query execution settings
+EXECUTION_SETTINGS = {
+    # Размещать каждый результат сразу после завершения его запроса
+    'streaming_placement': os.getenv('STREAMING_PLACEMENT', 'True').lower() == 'true',
+    # Сколько дней CUSTODY DEPOSITS выполнять параллельно
+    'custody_workers': int(os.getenv('CUSTODY_WORKERS', '3')),
+    # Однострочные KPI-запросы с одинаковыми параметрами выполнять одним запросом
+    'batch_scalar_queries': os.getenv('BATCH_SCALAR_QUERIES', 'True').lower() == 'true',
+    # Запросы с объявлением 'scan' по одной таблице и периоду выполнять одним проходом
+    'fuse_scans': os.getenv('FUSE_SCANS', 'False').lower() == 'true',
+    # KPI с объявлением 'local' считать локально по одной сырой выгрузке (query_config.RAW_EXTRACTS)
+    'local_metrics': os.getenv('LOCAL_METRICS', 'False').lower() == 'true',
+    # statement_timeout запросов по умолчанию, секунды (0 — без ограничения); 'timeout' в SQL_QUERIES важнее
+    'statement_timeout': int(os.getenv('STATEMENT_TIMEOUT', '0')),
+    # statement_timeout запроса одного дня CUSTODY DEPOSITS, секунды
+    'custody_timeout': int(os.getenv('CUSTODY_TIMEOUT', '600')),
+    # Файл со списком KPI, прерванных по таймауту в последнем запуске ('' — не писать)
+    'partial_report': os.getenv('PARTIAL_REPORT_PATH', 'kpi_partial_run.json'),
+}
+
+# On-disk result cache for closed reporting periods
+RESULT_CACHE = {
+    'enabled': os.getenv('RESULT_CACHE_ENABLED', 'True').lower() == 'true',
+    'directory': os.getenv('RESULT_CACHE_DIR', '.kpi_cache'),
+    'max_bytes': int(os.getenv('RESULT_CACHE_MAX_BYTES', str(512 * 1024 * 1024))),
+}
+
+# Local store of per-day partial aggregates for incremental weekly KPIs
+ROLLUP_STORE = {
+    'enabled': os.getenv('ROLLUP_STORE_ENABLED', 'True').lower() == 'true',
+    'path': os.getenv('ROLLUP_STORE_PATH', 'kpi_rollups.sqlite3'),
+}
+
+# Асинхронный режим: запросы через asyncpg и запись в Sheets через aiohttp в одном цикле событий
+# (нужны необязательные пакеты asyncpg и aiohttp)
+ASYNC_EXECUTION = {
+    'enabled': os.getenv('ASYNC_EXECUTION', 'False').lower() == 'true',
+    # Сколько запросов одновременно выполняется в БД (и размер пула asyncpg)
+    'db_concurrency': int(os.getenv('ASYNC_DB_CONCURRENCY', '10')),
+    # Сколько таблиц Google Sheets записываются одновременно
+    'sheets_concurrency': int(os.getenv('ASYNC_SHEETS_CONCURRENCY', '2')),
+}
+
+# История длительностей запросов: запуск в порядке longest-job-first и прогноз времени выполнения
+QUERY_HISTORY = {
+    'enabled': os.getenv('QUERY_HISTORY', 'True').lower() == 'true',
+    'path': os.getenv('QUERY_HISTORY_PATH', 'kpi_query_history.json'),
+    # Вес последнего запуска в сглаженной длительности
+    'alpha': float(os.getenv('QUERY_HISTORY_ALPHA', '0.3')),
+    # Задачи короче (попадания в кэш) в историю не пишутся
+    'min_seconds': float(os.getenv('QUERY_HISTORY_MIN_SECONDS', '0.5')),
+}
+
+# Планировщик (scheduler.py): долгоживущий процесс с общими подключениями к БД и Sheets
+SCHEDULER = {
+    'run_at': os.getenv('SCHEDULER_RUN_AT', '09:00'),
+    # Выполнить запуск сразу после старта процесса
+    'run_on_start': os.getenv('SCHEDULER_RUN_ON_START', 'False').lower() == 'true',
+    # Как часто проверяется расписание и обновляется файл состояния, секунды
+    'check_interval': int(os.getenv('SCHEDULER_CHECK_INTERVAL', '60')),
+    'health_file': os.getenv('SCHEDULER_HEALTH_FILE', 'kpi_scheduler_health.json'),
+}
+
 # Debug mode
 DEBUG_MODE = os.getenv('DEBUG_MODE', 'False').lower() == 'true'
 
@@ -42,6 +116,18 @@ SHEETS_DEBUG = {
     'log_ranges': os.getenv('SHEETS_LOG_RANGES', 'False').lower() == 'true'
 }
 
+# Google Sheets write settings
+SHEETS_SETTINGS = {
+    # Копить записи за запуск и отправлять одним values:batchUpdate на таблицу
+    'batch_writes': os.getenv('SHEETS_BATCH_WRITES', 'True').lower() == 'true',
+    # Квота Sheets API на пользователя и повторы при 429/503
+    'reads_per_minute': int(os.getenv('SHEETS_READS_PER_MINUTE', '60')),
+    'writes_per_minute': int(os.getenv('SHEETS_WRITES_PER_MINUTE', '60')),
+    'max_retries': int(os.getenv('SHEETS_MAX_RETRIES', '5')),
+    # Размещать результаты в разные таблицы параллельно (по потоку на таблицу)
+    'parallel_sinks': os.getenv('SHEETS_PARALLEL_SINKS', 'True').lower() == 'true',
+}
+
 # Logging configuration
 LOG_FILE = os.getenv('LOG_FILE', 'kpi_automation.log')
 LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(5 * 1024 * 1024)))
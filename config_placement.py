@@ -80,9 +80,14 @@ PLACEMENT_CONFIG = {
     'statuses_payout_reward': {
         'spreadsheet_id': 'sr_plus',
         'sheet_name': 'status',
-        'data_type': 'statuses_shift',
+        'data_type': 'rolling_columns',
         'placement': {
-            'status_values': 'E5:E15'
+            # Окно сдвигается влево (D -> C, E -> D), новые значения встают в E
+            'shift': [
+                {'source': 'D4:D16', 'destination': 'C4:C16'},
+                {'source': 'E4:E15', 'destination': 'D4:D15'},
+            ],
+            'values': 'E5:E15'
         }
     },
     'statuses_partner_liability': {
@@ -119,17 +124,55 @@ PLACEMENT_CONFIG = {
     },
 }
 
-QUERY_TO_CONFIG_MAPPING = {
-    'common_kpi': 'common_kpi',
-    'custody_deposits': 'custody_deposits_avg',
-    'tf_sr_payouts': 'tf_sr_payouts',
-    'tf_sr_partner_liability': 'tf_sr_partner_liability',
-    'tf_sr_submitted_to_finished': 'tf_sr_submitted_to_finished',
-    'tf_sr_median_payouts': 'tf_sr_median_payouts',
-    'statuses_payout_reward': 'statuses_payout_reward',
-    'statuses_partner_liability': 'statuses_partner_liability',
-    'sr_payouts_slow': 'sr_payouts_slow',
-    'currency_stats': 'currency_stats'
+# Размещение результатов запросов: запрос -> [размещения] в порядке записи.
+# 'target' — ключ PLACEMENT_CONFIG, 'extract' — что берётся из результата:
+#   'scalar' — значение колонки 'column' первой строки (записывается как поле 'field', по умолчанию = column),
+#   'metric' — значение 'value' строки, где metric == 'metric' (результат вида metric/value),
+#   'table' — весь DataFrame (таблицы, статусы),
+#   'common_kpi' — весь DataFrame, разбирается размещением common_kpi_table.
+# Размещения разных таблиц (spreadsheet_id) независимы и могут выполняться параллельно.
+RESULT_PLACEMENTS = {
+    'common_kpi': [
+        {'target': 'common_kpi', 'extract': 'common_kpi'},
+    ],
+    'custody_deposits': [
+        {'target': 'custody_deposits_avg', 'extract': 'metric', 'metric': 'avg_duration_sending_period',
+         'field': 'avg_duration_sending_weekly'},
+    ],
+    'tf_sr_payouts': [
+        {'target': 'tf_sr_payouts', 'extract': 'scalar', 'column': 'total_payouts'},
+        {'target': 'tf_sr_payouts', 'extract': 'scalar', 'column': 'long_payouts'},
+    ],
+    'tf_sr_partner_liability': [
+        {'target': 'tf_sr_partner_liability', 'extract': 'scalar', 'column': 'total_payouts'},
+        {'target': 'tf_sr_partner_liability', 'extract': 'scalar', 'column': 'long_payouts'},
+    ],
+    'tf_sr_median_payouts': [
+        {'target': 'tf_sr_median_payouts', 'extract': 'scalar', 'column': 'median_duration'},
+    ],
+    'tf_sr_submitted_to_finished': [
+        {'target': 'tf_sr_submitted_to_finished', 'extract': 'scalar', 'column': 'avg_duration'},
+    ],
+    'statuses_payout_reward': [
+        {'target': 'statuses_payout_reward', 'extract': 'table'},
+    ],
+    'sr_payouts_slow': [
+        {'target': 'sr_payouts_slow', 'extract': 'scalar', 'column': 'long_count'},
+    ],
+    'currency_stats': [
+        {'target': 'currency_stats', 'extract': 'table'},
+    ],
+    'statuses_partner_liability': [
+        {'target': 'statuses_partner_liability', 'extract': 'table'},
+    ],
+}
+
+# Размещения без результата запроса: выполняются после того, как успешно размещена
+# хотя бы одна из целей 'after' (для ссылок status -> TF_SR — когда строка недели на TF_SR выбрана)
+DEPENDENT_PLACEMENTS = {
+    'tf_sr_links_increment': {
+        'after': ['tf_sr_payouts', 'tf_sr_partner_liability', 'tf_sr_submitted_to_finished', 'tf_sr_median_payouts'],
+    },
 }
 
 PARALLEL_QUERIES = [
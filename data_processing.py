@@ -1,7 +1,10 @@
+import numpy as np
 import pandas as pd
 import re
 import logging
-from datetime import datetime, timedelta
+from collections.abc import Mapping
+from datetime import datetime
+from aggregates import MeanState, TDigest
 
 logger = logging.getLogger(__name__)
 
@@ -71,29 +74,29 @@ def process_common_kpi(df):
             for idx, row in df.iterrows():
                 result_str = row.iloc[0]
                 logger.info(f"process_common_kpi: row {idx}, result_str={result_str}")
-            # Регулярное выражение для извлечения данных в скобках
-            pattern = r'\(([^)]+)\)'
-            matches = re.findall(pattern, result_str)
+                # Регулярное выражение для извлечения данных в скобках
+                pattern = r'\(([^)]+)\)'
+                matches = re.findall(pattern, result_str)
                 logger.info(f"process_common_kpi: row {idx}, matches={matches}")
-            
-            for match in matches:
-                parts = [part.strip().strip('"') for part in match.split(',')]
+                
+                for match in matches:
+                    parts = [part.strip().strip('"') for part in match.split(',')]
                     logger.info(f"process_common_kpi: row {idx}, parts={parts}")
-                if len(parts) >= 6:
-                    metric_name = parts[2]
-                    values = parts[3:]  # Все значения начиная с 4-го элемента
-                    
-                    # Обрабатываем специальные случаи
+                    if len(parts) >= 6:
+                        metric_name = parts[2]
+                        values = parts[3:]  # Все значения начиная с 4-го элемента
+                        
+                        # Обрабатываем специальные случаи
                         if metric_name == "custody_conversion ":
-                        metric_name = "custody_conversion"
+                            metric_name = "custody_conversion"
                         elif metric_name == "reward ":
                             metric_name = "reward"
-                    
-                    result[metric_name] = {
-                        'values': values,
-                        'start_date': parts[0],
-                        'end_date': parts[1]
-                    }
+                        
+                        result[metric_name] = {
+                            'values': values,
+                            'start_date': parts[0],
+                            'end_date': parts[1]
+                        }
                         logger.info(f"process_common_kpi: row {idx}, added {metric_name} with values {values}")
             
         except Exception as e:
@@ -128,11 +131,150 @@ def process_statuses_data(df):
     return result
 
 def extract_single_value(df, column_name):
-    """Извлечение одиночного значения из DataFrame"""
+    """Извлечение одиночного значения из DataFrame или записи {колонка: значение} (database.fetch_scalar_row)"""
+    if isinstance(df, Mapping):
+        return df.get(column_name)
     if not df.empty and column_name in df.columns:
         return df[column_name].iloc[0]
     return None
 
+def combine_shard_results(frames, combine, group_by=None, order_by=None):
+    """Объединение результатов шардов одного запроса (части периода) в итог за весь период.
+
+    combine — комбинатор по колонкам: 'sum', 'min', 'max', ('mean', колонка_веса)
+    для AVG, взвешенного по количеству, или ('quantile', q, колонка_веса) для медиан:
+    строки шардов — центроиды (среднее корзины, вес), сливаемые в t-digest.
+    Необъявленные колонки берутся из первого шарда.
+    group_by — колонки группировки (строки объединяются по группам),
+    order_by — {колонка: 'asc' | 'desc'} для итоговой сортировки.
+    """
+    frames = [frame for frame in frames if frame is not None and not frame.empty]
+    if not frames:
+        return pd.DataFrame()
+
+    data = pd.concat(frames, ignore_index=True)
+    if group_by:
+        rows = [_combine_rows(group, combine) for _, group in data.groupby(group_by, sort=False, dropna=False)]
+    else:
+        rows = [_combine_rows(data, combine)]
+    result = pd.DataFrame(rows, columns=data.columns)
+
+    if order_by:
+        result = result.sort_values(list(order_by), ascending=[direction.lower() != 'desc' for direction in order_by.values()])
+        result = result.reset_index(drop=True)
+    return result
+
+def _combine_rows(rows, combine):
+    combined = {}
+    for column in rows.columns:
+        combiner = combine.get(column, 'first')
+        values = rows[column]
+        if combiner == 'sum':
+            combined[column] = values.sum()
+        elif combiner == 'min':
+            combined[column] = values.min()
+        elif combiner == 'max':
+            combined[column] = values.max()
+        elif isinstance(combiner, (tuple, list)) and combiner[0] == 'mean':
+            combined[column] = weighted_mean(values, rows[combiner[1]])
+        elif isinstance(combiner, (tuple, list)) and combiner[0] == 'quantile':
+            combined[column] = sketch_quantile(values, rows[combiner[2]], combiner[1])
+        else:
+            combined[column] = values.iloc[0]
+    return combined
+
+def weighted_mean(values, weights):
+    """Среднее, взвешенное по количеству (timedelta поддерживается); шарды без данных пропускаются"""
+    state = MeanState(0, 0)
+    is_timedelta = False
+    for value, weight in zip(values, weights):
+        if pd.isna(value) or pd.isna(weight) or weight == 0:
+            continue
+        if hasattr(value, 'total_seconds'):
+            is_timedelta = True
+            value = value.total_seconds()
+        state.add(value, weight)
+    mean = state.mean
+    if mean is None:
+        return None
+    return pd.Timedelta(seconds=mean) if is_timedelta else mean
+
+def sketch_quantile(values, weights, q):
+    """Квантиль по центроидам шардов (среднее корзины, вес корзины) через t-digest"""
+    digest = TDigest()
+    is_timedelta = False
+    for value, weight in zip(values, weights):
+        if pd.isna(value) or pd.isna(weight):
+            continue
+        if hasattr(value, 'total_seconds'):
+            is_timedelta = True
+            value = value.total_seconds()
+        digest.add(value, weight)
+    result = digest.quantile(q)
+    if result is None:
+        return None
+    return pd.Timedelta(seconds=result) if is_timedelta else result
+
+def compute_local_metrics(raw, spec, start=None, end=None):
+    """Локальный расчёт KPI по сырой выгрузке (альтернатива агрегации в БД).
+
+    spec — описание 'local' запроса: 'period_column' (фильтр [start, end) по колонке),
+    'where' (выражение DataFrame.eval), 'aggregates' {колонка: агрегат}, необязательные
+    'group_by' и 'order_by' {колонка: 'asc' | 'desc'}. Агрегаты: 'count' или ('count', условие),
+    ('percent', условие) — доля строк в процентах как '12.50%', ('mean' | 'median' | 'sum'
+    | 'min' | 'max', колонка или выражение). Медиана точная; все операции векторные.
+    """
+    mask = np.ones(len(raw), dtype=bool)
+    period_column = spec.get('period_column')
+    if period_column and start is not None:
+        values = pd.to_datetime(raw[period_column])
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        if values.dt.tz is not None:
+            start, end = start.tz_localize(values.dt.tz), end.tz_localize(values.dt.tz)
+        mask &= ((values >= start) & (values < end)).to_numpy()
+    if spec.get('where'):
+        mask &= raw.eval(spec['where']).to_numpy(dtype=bool)
+    frame = raw[mask]
+
+    # Колонки для агрегации: маски условий и значения выражений
+    kinds = {}
+    data = pd.DataFrame(index=frame.index)
+    for column, aggregate in spec['aggregates'].items():
+        kind, argument = (aggregate, None) if isinstance(aggregate, str) else aggregate
+        kinds[column] = kind
+        if kind in ('count', 'percent'):
+            data[column] = frame.eval(argument).astype(bool) if argument else True
+        else:
+            data[column] = frame[argument] if argument in frame.columns else frame.eval(argument)
+
+    group_by = spec.get('group_by')
+    if group_by:
+        grouped = data.groupby([frame[column] for column in group_by], sort=False)
+        result = pd.DataFrame({column: _reduce_local(grouped[column], kind) for column, kind in kinds.items()})
+        result = result.reset_index()
+    else:
+        result = pd.DataFrame([{column: _reduce_local(data[column], kind) for column, kind in kinds.items()}])
+
+    for column, kind in kinds.items():
+        if kind == 'percent':
+            result[column] = result[column].map(lambda share: None if pd.isna(share) else f"{share * 100:.2f}%")
+
+    order_by = spec.get('order_by')
+    if order_by:
+        result = result.sort_values(list(order_by), ascending=[direction.lower() != 'desc' for direction in order_by.values()])
+        result = result.reset_index(drop=True)
+    return result
+
+def _reduce_local(values, kind):
+    """Свёртка колонки (Series или SeriesGroupBy) агрегатом compute_local_metrics"""
+    if kind == 'count':
+        return values.sum()
+    if kind == 'percent':
+        return values.mean()
+    if kind in ('mean', 'median', 'sum', 'min', 'max'):
+        return getattr(values, kind)()
+    raise ValueError(f"Неизвестный агрегат: {kind}")
+
 def convert_timedelta_to_seconds(value):
     """Преобразует timedelta в секунды (число)"""
     if hasattr(value, 'total_seconds'):
@@ -1,28 +1,310 @@
 import pandas as pd
+from datetime import timedelta
+from decimal import Decimal
 from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
 import logging
+import threading
+import time
 import config
 
 logger = logging.getLogger(__name__)
 
+# SQLSTATE query_canceled: запрос отменён сервером, в т.ч. по statement_timeout
+QUERY_CANCELED = '57014'
+
+
+class QueryTimeoutError(Exception):
+    """Запрос отменён PostgreSQL по statement_timeout.
+
+    names — имена прерванных запросов; records — записи, которые успели выполниться
+    (для пакета однострочных запросов).
+    """
+
+    def __init__(self, names, timeout, records=None):
+        self.names = list(names)
+        self.timeout = timeout
+        self.records = records or {}
+        super().__init__(f"{', '.join(self.names)}: превышен таймаут {timeout} с")
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool, считающий выдачи соединений и время ожидания свободного соединения"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+
+def pool_settings():
+    """Параметры пула соединений: размер по числу потоков, которые одновременно ходят в БД.
+
+    Параллельный исполнитель держит до MAX_WORKERS соединений, CUSTODY DEPOSITS — ещё до
+    custody_workers (из слота исполнителя), поэтому пул по умолчанию равен их сумме.
+    """
+    settings = getattr(config, 'DB_POOL', {})
+    workers = config.MAX_WORKERS + getattr(config, 'EXECUTION_SETTINGS', {}).get('custody_workers', 1)
+    return {
+        'pool_size': settings.get('pool_size') or workers,
+        'max_overflow': settings.get('max_overflow', 2),
+        'pool_timeout': settings.get('pool_timeout', 30),
+        'pool_recycle': settings.get('pool_recycle', 1800),
+        'pool_pre_ping': settings.get('pool_pre_ping', True),
+    }
+
 def create_db_connection():
     """Создание подключения к базе данных"""
     try:
         logger.info("Пытаемся подключиться к базе данных")
         connection_string = f"postgresql+psycopg2://{config.DB_CONFIG['user']}:{config.DB_CONFIG['password']}@{config.DB_CONFIG['host']}:{config.DB_CONFIG['port']}/{config.DB_CONFIG['database']}"
-        engine = create_engine(connection_string)
-        logger.info("Успешное подключение к БД")
+        settings = pool_settings()
+        engine = create_engine(
+            connection_string,
+            poolclass=TimedQueuePool,
+            connect_args={
+                'connect_timeout': getattr(config, 'DB_POOL', {}).get('connect_timeout', 10),
+                'application_name': getattr(config, 'DB_POOL', {}).get('application_name', 'kpi_automation'),
+            },
+            **settings,
+        )
+        logger.info(f"Успешное подключение к БД (пул: {settings['pool_size']} + {settings['max_overflow']})")
         return engine
     except Exception as e:
         logger.error(f"Ошибка подключения к БД: {e}")
         return None
 
-def execute_query(engine, query, params=None, query_name="Unknown"):
-    """Выполнение SQL-запроса"""
+def check_connection(engine):
+    """Проверка движка долгоживущего процесса: SELECT 1 через пул. False — БД недоступна"""
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        return True
+    except Exception as e:
+        logger.warning(f"Проверка соединения с БД не прошла: {e}")
+        return False
+
+def get_pool_stats(engine):
+    """Метрики пула соединений: выдачи, ожидание свободного соединения, занятость"""
+    pool = engine.pool
+    stats = {}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+        })
+    if isinstance(pool, TimedQueuePool):
+        with pool._stats_lock:
+            stats.update({
+                'checkouts': pool.checkouts,
+                'wait_seconds_total': pool.wait_seconds_total,
+                'wait_seconds_max': pool.wait_seconds_max,
+            })
+    return stats
+
+def log_pool_stats(engine):
+    stats = get_pool_stats(engine)
+    logger.info(f"Пул соединений БД: выдач {stats.get('checkouts', 0)}, "
+                f"ожидание {stats.get('wait_seconds_total', 0.0):.2f} с (макс. {stats.get('wait_seconds_max', 0.0):.2f} с), "
+                f"размер {stats.get('size')}, переполнение {stats.get('overflow')}")
+    return stats
+
+def query_timeout(spec):
+    """Таймаут запроса в секундах: 'timeout' из описания запроса или EXECUTION_SETTINGS['statement_timeout'].
+
+    None — без ограничения.
+    """
+    timeout = (spec or {}).get('timeout', getattr(config, 'EXECUTION_SETTINGS', {}).get('statement_timeout'))
+    return timeout or None
+
+def set_statement_timeout(connection, timeout):
+    """statement_timeout на текущую транзакцию соединения (как SET LOCAL).
+
+    По истечении PostgreSQL сам отменяет запрос на своей стороне и освобождает backend;
+    соединение возвращается в пул после отката транзакции.
+    """
+    if timeout:
+        connection.execute(text("SELECT set_config('statement_timeout', :value, true)"),
+                           {'value': str(int(timeout * 1000))})
+
+def is_statement_timeout(error):
+    """Ошибка — отмена запроса сервером (SQLSTATE 57014)"""
+    return getattr(getattr(error, 'orig', None), 'pgcode', None) == QUERY_CANCELED
+
+def native_value(value):
+    """Значение из курсора DBAPI в тот же тип, что дал бы read_sql: interval -> pd.Timedelta, numeric -> float"""
+    if isinstance(value, timedelta):
+        return pd.Timedelta(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+def fetch_records(engine, query, params=None, query_name="Unknown", timeout=None):
+    """Выполнение SQL-запроса без pandas: список записей {колонка: значение} прямо из курсора.
+
+    Для коротких результатов (KPI из одной строки), где построение DataFrame и вывод типов
+    стоят дороже самих данных. При ошибке возвращает пустой список; при превышении
+    timeout (секунды) — QueryTimeoutError.
+    """
+    try:
+        logger.info(f"Выполняем запрос: {query_name}")
+        with engine.connect() as connection:
+            set_statement_timeout(connection, timeout)
+            result = connection.execute(text(query), params or {})
+            columns = list(result.keys())
+            records = [dict(zip(columns, map(native_value, row))) for row in result]
+        logger.info(f"Запрос {query_name} выполнен. Получено {len(records)} строк")
+        if records:
+            logger.info(f"Первая строка {query_name}: {records[0]}")
+        else:
+            logger.warning(f"Запрос {query_name} вернул пустой результат")
+        return records
+    except Exception as e:
+        if is_statement_timeout(e):
+            logger.error(f"Запрос {query_name} прерван: превышен таймаут {timeout} с")
+            raise QueryTimeoutError([query_name], timeout) from e
+        logger.error(f"Ошибка выполнения запроса {query_name}: {e}")
+        return []
+
+def fetch_scalar_row(engine, query, params=None, query_name="Unknown", cache=None, timeout=None):
+    """Первая строка результата как {колонка: значение} ({} — пустой результат или ошибка).
+
+    Кэш результатов (result_cache.ResultCache) и timeout используются так же, как в execute_query.
+    """
+    cache_key = None
+    if cache is not None and cache.accepts(params):
+        cache_key = cache.key(query_name, query, params)
+        df = cache.get(query_name, cache_key)
+        if df is not None:
+            logger.info(f"Запрос {query_name} взят из кэша")
+            return {column: native_value(value) for column, value in df.iloc[0].items()} if not df.empty else {}
+
+    records = fetch_records(engine, query, params, query_name, timeout)
+    if cache_key is not None and records:
+        cache.put(query_name, cache_key, pd.DataFrame(records[:1]))
+    return records[0] if records else {}
+
+def build_scalar_batch(queries):
+    """Один SELECT из нескольких однострочных запросов с общими параметрами.
+
+    Каждый запрос подключается как LEFT JOIN LATERAL (... LIMIT 1), перед его колонками идёт
+    колонка-маркер "__q<i>", по которой строка результата делится обратно на запросы.
+    Возвращает (текст запроса, [имена запросов в порядке маркеров]).
+    """
+    names = list(queries)
+    columns = []
+    joins = []
+    for i, name in enumerate(names):
+        query = queries[name].strip().rstrip(';')
+        columns.append(f'1 AS "__q{i}", q{i}.*')
+        joins.append(f"LEFT JOIN LATERAL (SELECT * FROM ({query}\n) AS inner_q{i} LIMIT 1) AS q{i} ON TRUE")
+    statement = f"SELECT {', '.join(columns)}\nFROM (SELECT 1) AS batch_base\n" + "\n".join(joins)
+    return statement, names
+
+def split_scalar_batch(columns, row, names):
+    """Делит строку объединённого результата по колонкам-маркерам на записи запросов.
+
+    Пустой результат запроса (все колонки NULL после LEFT JOIN) даёт {}.
+    """
+    records = {}
+    markers = [columns.index(f"__q{i}") for i in range(len(names))] + [len(columns)]
+    for i, name in enumerate(names):
+        record = {column: native_value(value)
+                  for column, value in zip(columns[markers[i] + 1:markers[i + 1]], row[markers[i] + 1:markers[i + 1]])}
+        records[name] = record if any(value is not None for value in record.values()) else {}
+    return records
+
+def fetch_scalar_batch(engine, queries, params=None, cache=None, timeout=None):
+    """Однострочные запросы с одинаковыми параметрами за один запрос к БД (одно соединение, один round-trip).
+
+    queries — {имя: текст SQL}. Возвращает {имя: запись}. Результаты из кэша в пакет не входят;
+    если объединённый запрос завершился ошибкой (в т.ч. по timeout), запросы выполняются
+    по отдельности. Если отдельные запросы превысили timeout, после выполнения остальных
+    выбрасывается QueryTimeoutError с их именами и записями остальных.
+    """
+    records = {}
+    pending = {}
+    cache_keys = {}
+    for name, query in queries.items():
+        if cache is not None and cache.accepts(params):
+            cache_keys[name] = cache.key(name, query, params)
+            df = cache.get(name, cache_keys[name])
+            if df is not None:
+                records[name] = {column: native_value(value) for column, value in df.iloc[0].items()} if not df.empty else {}
+                continue
+        pending[name] = query
+    if not pending:
+        return records
+
+    statement, names = build_scalar_batch(pending)
+    try:
+        logger.info(f"Выполняем пакет однострочных запросов: {', '.join(names)}")
+        with engine.connect() as connection:
+            set_statement_timeout(connection, timeout)
+            result = connection.execute(text(statement), params or {})
+            columns = list(result.keys())
+            row = result.fetchone()
+        batch_records = split_scalar_batch(columns, row, names)
+        logger.info(f"Пакет из {len(names)} запросов выполнен")
+    except Exception as e:
+        logger.warning(f"Пакет однострочных запросов не выполнен ({e}), выполняем запросы по отдельности")
+        timed_out = []
+        for name in names:
+            try:
+                records[name] = fetch_scalar_row(engine, pending[name], params, name, cache, timeout)
+            except QueryTimeoutError:
+                timed_out.append(name)
+        if timed_out:
+            raise QueryTimeoutError(timed_out, timeout, records)
+        return records
+
+    for name, record in batch_records.items():
+        logger.info(f"Запрос {name}: {record}")
+        if name in cache_keys and record:
+            cache.put(name, cache_keys[name], pd.DataFrame([record]))
+        records[name] = record
+    return records
+
+def execute_query(engine, query, params=None, query_name="Unknown", cache=None, timeout=None, raise_errors=False):
+    """Выполнение SQL-запроса.
+
+    Если передан cache (result_cache.ResultCache), результат за закрытый период
+    берётся из кэша на диске, а после выполнения сохраняется в него.
+    timeout — statement_timeout запроса в секундах: по его истечении PostgreSQL отменяет
+    запрос и выбрасывается QueryTimeoutError (прочие ошибки дают пустой DataFrame).
+    raise_errors — прочие ошибки тоже пробрасываются: пустой DataFrame тогда всегда означает
+    пустой результат (так выполняются шарды, у которых ноль строк — допустимый ответ).
+    """
+    cache_key = None
+    if cache is not None and cache.accepts(params):
+        cache_key = cache.key(query_name, query, params)
+        df = cache.get(query_name, cache_key)
+        if df is not None:
+            logger.info(f"Запрос {query_name} взят из кэша. Получено {len(df)} строк")
+            return df
+
     try:
         logger.info(f"Выполняем запрос: {query_name}")
         
-        if params:
+        if timeout:
+            with engine.connect() as connection:
+                set_statement_timeout(connection, timeout)
+                df = pd.read_sql_query(text(query), connection, params=params or None)
+        elif params:
             df = pd.read_sql_query(text(query), engine, params=params)
         else:
             df = pd.read_sql_query(text(query), engine)
@@ -38,7 +320,42 @@ def execute_query(engine, query, params=None, query_name="Unknown"):
         else:
             logger.warning(f"Запрос {query_name} вернул пустой результат")
         
+        if cache_key is not None:
+            cache.put(query_name, cache_key, df)
         return df
     except Exception as e:
+        if is_statement_timeout(e):
+            logger.error(f"Запрос {query_name} прерван: превышен таймаут {timeout} с")
+            raise QueryTimeoutError([query_name], timeout) from e
         logger.error(f"Ошибка выполнения запроса {query_name}: {e}")
-        return pd.DataFrame()
\ No newline at end of file
+        if raise_errors:
+            raise
+        return pd.DataFrame()
+
+def iter_query_chunks(engine, query, params=None, query_name="Unknown", chunksize=5000, timeout=None):
+    """Потоковое выполнение SQL-запроса: DataFrame по chunksize строк.
+
+    Строки читаются через именованный (серверный) курсор psycopg2 (stream_results),
+    поэтому в памяти одновременно находится не больше одного чанка. Соединение занято,
+    пока генератор не исчерпан или не закрыт. Ошибка логируется и пробрасывается дальше:
+    часть чанков к этому моменту уже может быть обработана вызывающим кодом.
+    timeout ограничивает каждое чтение из курсора (statement_timeout), превышение —
+    QueryTimeoutError.
+    """
+    logger.info(f"Выполняем потоковый запрос: {query_name} (chunksize={chunksize})")
+    total = 0
+    try:
+        with engine.connect() as connection:
+            set_statement_timeout(connection, timeout)
+            result = connection.execution_options(stream_results=True, max_row_buffer=chunksize).execute(
+                text(query), params or {})
+            columns = list(result.keys())
+            for rows in result.partitions(chunksize):
+                total += len(rows)
+                yield pd.DataFrame([[native_value(value) for value in row] for row in rows], columns=columns)
+    except Exception as e:
+        logger.error(f"Ошибка потокового запроса {query_name} после {total} строк: {e}")
+        if is_statement_timeout(e):
+            raise QueryTimeoutError([query_name], timeout) from e
+        raise
+    logger.info(f"Потоковый запрос {query_name} выполнен. Получено {total} строк")
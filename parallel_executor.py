@@ -1,35 +1,282 @@
 import concurrent.futures
+import time
+from datetime import datetime, timedelta
 from functools import partial
 import logging
 import database
+import data_processing
+from rollup_store import RollupStore
 import pandas as pd
 
 logger = logging.getLogger(__name__)
 
-def execute_parallel_queries(engine, queries_with_params, max_workers=5):
+# Шаг и формат границ для шардирования периода запроса
+SHARD_STEPS = {'day': timedelta(days=1), 'hour': timedelta(hours=1)}
+SHARD_FORMATS = {'day': '%Y-%m-%d', 'hour': '%Y-%m-%d %H:%M:%S'}
+
+def execute_parallel_queries(engine, queries_with_params, max_workers=5, extra_tasks=None, query_specs=None, cache=None,
+                             rollups=None, scalar_queries=(), batch_scalars=False, history=None, timed_out=None):
     """Выполнение запросов параллельно"""
-    results = {}
-    
-    # Создаем partial функцию для выполнения запроса
-    execute_func = partial(execute_query_with_name, engine)
+    return dict(iter_parallel_queries(engine, queries_with_params, max_workers, extra_tasks, query_specs, cache, rollups,
+                                      scalar_queries, batch_scalars, history, timed_out))
+
+def iter_parallel_queries(engine, queries_with_params, max_workers=5, extra_tasks=None, query_specs=None, cache=None,
+                          rollups=None, scalar_queries=(), batch_scalars=False, history=None, timed_out=None):
+    """Выполнение запросов параллельно с выдачей пар (имя, DataFrame) по мере завершения.
+
+    extra_tasks — {имя: функция без аргументов, возвращающая DataFrame}, выполняются в том же пуле.
+    query_specs — описания запросов (query_config.SQL_QUERIES): запросы с объявлением
+    'shard' разбиваются на подпериоды, а их результаты объединяются комбинаторами 'combine'.
+    cache — кэш результатов (result_cache.ResultCache) для закрытых периодов.
+    rollups — хранилище дневных агрегатов (rollup_store.RollupStore): дневные шарды, которые
+    уже есть в нём, не выполняются, а новые закрытые дни сохраняются.
+    scalar_queries — имена запросов из одной строки: выполняются без pandas (database.fetch_scalar_row),
+    результат — запись {колонка: значение} вместо DataFrame.
+    batch_scalars — однострочные запросы с одинаковыми параметрами выполняются одним
+    объединённым запросом (database.fetch_scalar_batch) за один round-trip.
+    history — история длительностей (query_history.QueryHistory): задачи запускаются в порядке
+    убывания ожидаемой длительности, до запуска логируется прогноз, после — факт; длительности
+    этого запуска сохраняются в историю.
+    timed_out — список, в который добавляются имена запросов, прерванных по таймауту
+    ('timeout' в описании запроса или EXECUTION_SETTINGS['statement_timeout']). Вместо их
+    результатов выдаются пустые, остальные запросы выполняются и выдаются как обычно.
+    Так же учитывается шардируемый запрос, шард которого завершился ошибкой: значение за период
+    без него было бы неполным. Пустой результат шарда (тихий день или час) ошибкой не считается.
+    """
+    # Создаем partial функцию для выполнения запроса; ошибка шарда пробрасывается, а не даёт пустой результат
+    execute_func = partial(execute_query_with_name, engine, cache=cache)
+    shard_func = partial(execute_query_with_name, engine, cache=cache, raise_errors=True)
+    scalar_func = partial(fetch_scalar_with_name, engine, cache=cache)
+
+    # Разбиваем шардируемые запросы на подпериоды
+    tasks = {}
+    shard_parent = {}   # имя шарда -> имя запроса
+    shard_names = {}    # имя запроса -> [имена шардов в порядке периода]
+    shard_results = {}  # имя запроса -> {имя шарда: DataFrame}
+    versions = {}       # имя запроса -> версия дневных агрегатов в rollups
+    for name, (query, params) in queries_with_params.items():
+        spec = (query_specs or {}).get(name, {})
+        shards = plan_shards(name, query, params, spec)
+        if not shards:
+            tasks[name] = (query, params)
+            continue
+        logger.info(f"Запрос {name} разбит на {len(shards)} шардов")
+        shard_names[name] = []
+        shard_results[name] = {}
+        if rollups is not None and spec.get('shard') == 'day':
+            versions[name] = RollupStore.version(spec.get('shard_query', query))
+        for shard_name, shard_query, shard_params in shards:
+            shard_names[name].append(shard_name)
+            stored = rollups.get(rollup_name(name), shard_day(shard_name), versions[name]) if name in versions else None
+            if stored is not None:
+                shard_results[name][shard_name] = stored
+                continue
+            tasks[shard_name] = (shard_query, shard_params)
+            shard_parent[shard_name] = name
+        if name in versions:
+            logger.info(f"Запрос {name}: дней из хранилища агрегатов {len(shard_results[name])}, "
+                        f"к выполнению {len(shards) - len(shard_results[name])}")
+
+    # Таймауты запросов (statement_timeout); шарды наследуют таймаут запроса
+    timeouts = {name: database.query_timeout((query_specs or {}).get(shard_parent.get(name, name)))
+                for name in tasks}
+
+    # Однострочные запросы с общими параметрами объединяются в пакеты
+    batches = group_scalar_batches(tasks, scalar_queries) if batch_scalars else []
+
+    # Запросы, все дни которых уже есть в хранилище агрегатов, собираются без обращения к БД
+    for name in list(shard_names):
+        if len(shard_results[name]) == len(shard_names[name]):
+            yield name, merge_shards(name, [shard_results[name][shard] for shard in shard_names[name]], query_specs[name])
     
+    # Задачи пула: дополнительные задачи (обычно самые долгие) первыми, затем запросы и пакеты
+    jobs = {name: (task,) for name, task in (extra_tasks or {}).items()}
+    for name, (query, params) in tasks.items():
+        func = shard_func if name in shard_parent else scalar_func if name in scalar_queries else execute_func
+        jobs[name] = (func, query, params, name, timeouts[name])
+    batch_names = {}
+    for queries, params in batches:
+        batch_name = batch_key(queries)
+        member_timeouts = [timeouts[name] for name in queries]
+        batch_timeout = max(member_timeouts) if all(member_timeouts) else None
+        jobs[batch_name] = (database.fetch_scalar_batch, engine, queries, params, cache, batch_timeout)
+        batch_names[batch_name] = list(queries)
+
+    order = list(jobs)
+    predicted = None
+    if history is not None and jobs:
+        # Longest-job-first: самые долгие по истории задачи не остаются хвостом в конце запуска
+        order = history.order(order)
+        estimate, longest_name, longest, unknown = history.estimate(order, max_workers)
+        if unknown < len(order):
+            predicted = estimate
+            logger.info(f"Прогноз выполнения: {predicted:.1f} с на {max_workers} потоках, {len(order)} задач"
+                        f" (без истории: {unknown}); критический путь — {longest_name} ({longest:.1f} с)")
+        else:
+            logger.info("История длительностей пуста: прогноз выполнения будет после первого запуска")
+
+    durations = {}
+    timed_out_parents = set()
+    started = time.perf_counter()
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Запускаем запросы параллельно
-        future_to_query = {executor.submit(execute_func, query, params, name): name 
-                          for name, (query, params) in queries_with_params.items()}
+        future_to_query = {executor.submit(timed_call, durations, name, *jobs[name]): name for name in order}
         
-        # Собираем результаты
+        # Отдаём результаты по мере готовности
         for future in concurrent.futures.as_completed(future_to_query):
             query_name = future_to_query[future]
+            if query_name in batch_names:
+                try:
+                    records = future.result()
+                except database.QueryTimeoutError as e:
+                    report_timeout(timed_out, e.names)
+                    records = e.records
+                except Exception as e:
+                    logger.error(f"Ошибка в пакете запросов {', '.join(batch_names[query_name])}: {e}")
+                    records = {}
+                for name in batch_names[query_name]:
+                    logger.info(f"Запрос {name} завершен")
+                    yield name, records.get(name, {})
+                continue
+            parent = shard_parent.get(query_name)
+            failed = False
             try:
-                results[query_name] = future.result()
+                result = future.result()
                 logger.info(f"Запрос {query_name} завершен")
+            except database.QueryTimeoutError:
+                if parent is None or parent not in timed_out_parents:
+                    report_timeout(timed_out, [parent or query_name])
+                if parent is not None:
+                    timed_out_parents.add(parent)
+                result = pd.DataFrame()
+                failed = True
             except Exception as e:
                 logger.error(f"Ошибка в запросе {query_name}: {e}")
-                results[query_name] = pd.DataFrame()
-    
-    return results
+                # Ошибка шарда, как и таймаут, делает значение за период неполным
+                if parent is not None and parent not in timed_out_parents:
+                    report_timeout(timed_out, [parent], "из-за ошибки шарда")
+                    timed_out_parents.add(parent)
+                result = pd.DataFrame()
+                failed = True
+
+            if parent is None:
+                yield query_name, result
+                continue
+
+            # Шард: ждём остальные шарды запроса и объединяем их в порядке периода
+            if not failed and parent in versions:
+                rollups.put(rollup_name(parent), shard_day(query_name), versions[parent], result)
+            shard_results[parent][query_name] = result
+            if len(shard_results[parent]) == len(shard_names[parent]):
+                if parent in timed_out_parents:
+                    # Без прерванного шарда значение за период было бы неполным
+                    yield parent, pd.DataFrame()
+                    continue
+                frames = [shard_results[parent][name] for name in shard_names[parent]]
+                yield parent, merge_shards(parent, frames, query_specs[parent])
+
+    if history is not None and durations:
+        actual = time.perf_counter() - started
+        forecast = f" (прогноз {predicted:.1f} с)" if predicted is not None else ""
+        logger.info(f"Выполнение заняло {actual:.1f} с{forecast}")
+        for name, seconds in durations.items():
+            history.record(name, seconds)
+        history.save()
 
-def execute_query_with_name(engine, query, params, name):
+def timed_call(durations, name, func, *args):
+    """Вызов задачи пула с записью её длительности в durations[name]"""
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        durations[name] = time.perf_counter() - started
+
+def report_timeout(timed_out, names, reason="по таймауту"):
+    """Логирует запросы, прерванные по таймауту (или с неполным периодом), и добавляет их в список timed_out"""
+    logger.error(f"Прерваны {reason}: {', '.join(names)}; остальные результаты будут размещены")
+    if timed_out is not None:
+        timed_out.extend(names)
+
+def batch_key(queries):
+    """Имя задачи пакета однострочных запросов (и ключ его истории длительностей)"""
+    return 'batch:' + '+'.join(sorted(queries))
+
+def group_scalar_batches(tasks, scalar_queries):
+    """Извлекает из tasks однострочные запросы с одинаковыми параметрами.
+
+    Возвращает [({имя: текст SQL}, параметры)] для групп из двух и более запросов;
+    одиночные запросы остаются в tasks.
+    """
+    groups = {}
+    for name, (query, params) in tasks.items():
+        if name in scalar_queries:
+            groups.setdefault(frozenset((params or {}).items()), []).append(name)
+    batches = []
+    for names in groups.values():
+        if len(names) < 2:
+            continue
+        params = tasks[names[0]][1]
+        batches.append(({name: tasks.pop(name)[0] for name in names}, params))
+        logger.info(f"Однострочные запросы объединены в пакет: {', '.join(names)}")
+    return batches
+
+def plan_shards(name, query, params, spec):
+    """Разбивает период запроса на подпериоды согласно объявлению spec['shard'] ('day' или 'hour').
+
+    Границы берутся из параметров, объявленных как ':start_week' и ':end_week_exclusive';
+    запрос должен фильтровать период полуоткрыто (>= начало AND < конец). Шарды выполняют
+    spec['shard_query'], если он объявлен (например, скетч вместо точной медианы), иначе query.
+    Возвращает [(имя шарда, запрос, параметры)] или [], если шардирование не объявлено.
+    """
+    shard = spec.get('shard')
+    if not shard:
+        return []
+    placeholders = spec.get('params', {})
+    start_param = next((param for param, value in placeholders.items() if value == ':start_week'), None)
+    end_param = next((param for param, value in placeholders.items() if value == ':end_week_exclusive'), None)
+    if shard not in SHARD_STEPS or not start_param or not end_param:
+        logger.warning(f"Шардирование {name} пропущено: нужен shard из {list(SHARD_STEPS)} "
+                       f"и параметры ':start_week'/':end_week_exclusive'")
+        return []
+
+    fmt = SHARD_FORMATS[shard]
+    query = spec.get('shard_query', query)
+    shards = []
+    for shard_start, shard_end in split_period(params[start_param], params[end_param], SHARD_STEPS[shard]):
+        shard_params = dict(params)
+        shard_params[start_param] = shard_start.strftime(fmt)
+        shard_params[end_param] = shard_end.strftime(fmt)
+        shards.append((f"{name}@{shard_start.strftime(fmt)}", query, shard_params))
+    return shards
+
+def rollup_name(name):
+    """Имя запроса в хранилище дневных агрегатов: без суффикса задачи ('name@неделя' в backfill)"""
+    return name.split('@', 1)[0]
+
+def shard_day(shard_name):
+    """Начало периода шарда из его имени (name@YYYY-MM-DD)"""
+    return shard_name.rsplit('@', 1)[1]
+
+def split_period(start, end, step):
+    """Подынтервалы [начало, конец) с шагом step, последний обрезается по концу периода"""
+    current = datetime.fromisoformat(str(start))
+    end = datetime.fromisoformat(str(end))
+    periods = []
+    while current < end:
+        periods.append((current, min(current + step, end)))
+        current += step
+    return periods
+
+def merge_shards(name, frames, spec):
+    """Объединение результатов шардов запроса комбинаторами из spec['combine']"""
+    result = data_processing.combine_shard_results(
+        frames, spec.get('combine', {}), spec.get('group_by'), spec.get('order_by'))
+    logger.info(f"Шарды {name} объединены: {len(result)} строк")
+    return result
+
+def execute_query_with_name(engine, query, params, name, timeout=None, cache=None, raise_errors=False):
     """Вспомогательная функция для выполнения запроса с именем"""
-    return database.execute_query(engine, query, params, name)
\ No newline at end of file
+    return database.execute_query(engine, query, params, name, cache, timeout, raise_errors=raise_errors)
+
+def fetch_scalar_with_name(engine, query, params, name, timeout=None, cache=None):
+    """Вспомогательная функция для запроса из одной строки"""
+    return database.fetch_scalar_row(engine, query, params, name, cache, timeout)
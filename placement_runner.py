@@ -0,0 +1,138 @@
+import concurrent.futures
+import logging
+import queue
+import threading
+import pandas as pd
+import config
+import config_placement
+import sheet_placement
+from data_processing import extract_single_value
+
+logger = logging.getLogger(__name__)
+
+
+def extract(df, entry):
+    """Аргументы update_sheet_precise (DataFrame, поле, значение) по описанию размещения из RESULT_PLACEMENTS.
+
+    None — размещать нечего (нет колонки, строки метрики или значения).
+    """
+    kind = entry['extract']
+    if kind == 'scalar':
+        value = extract_single_value(df, entry['column'])
+        return None if value is None else (None, entry.get('field', entry['column']), value)
+    if kind == 'metric':
+        if not isinstance(df, pd.DataFrame) or 'metric' not in df.columns:
+            return None
+        rows = df[df['metric'] == entry['metric']]
+        return None if rows.empty else (None, entry['field'], rows['value'].iloc[0])
+    if kind == 'common_kpi':
+        return df, 'common_kpi', None
+    if kind == 'table':
+        return df, None, None
+    raise ValueError(f"Неизвестный способ извлечения результата: {kind}")
+
+def sink(target):
+    """Таблица (ключ spreadsheet_id в PLACEMENT_CONFIG), в которую пишет цель размещения"""
+    return config_placement.PLACEMENT_CONFIG[target]['spreadsheet_id']
+
+
+class PlacementRunner:
+    """Размещение результатов запросов по config_placement.RESULT_PLACEMENTS.
+
+    Размещения группируются по таблицам: разные таблицы независимы и пишутся каждая своим
+    потоком (SHEETS_SETTINGS['parallel_sinks']), размещения одной таблицы идут по порядку
+    RESULT_PLACEMENTS. Зависимые размещения (DEPENDENT_PLACEMENTS) выполняет place_dependent()
+    после того, как размещены их цели. session — sheet_placement.PlacementSession запуска:
+    строки недели, план записи и размещённые цели хранятся в нём.
+    """
+
+    def __init__(self, session, parallel=None):
+        self.session = session
+        if parallel is None:
+            parallel = getattr(config, 'SHEETS_SETTINGS', {}).get('parallel_sinks', True)
+        self.parallel = parallel
+        self._mirror_thread = None
+        self._queues = {}
+        self._writers = []
+
+    def tasks(self, query_name, df):
+        """Размещения результата запроса по таблицам: {таблица: [(цель, DataFrame, поле, значение)]}"""
+        tasks = {}
+        if df is None or len(df) == 0:
+            return tasks
+        for entry in config_placement.RESULT_PLACEMENTS.get(query_name, []):
+            args = extract(df, entry)
+            if args is not None:
+                tasks.setdefault(sink(entry['target']), []).append((entry['target'],) + args)
+        return tasks
+
+    def _run(self, tasks):
+        for target, df, field, value in tasks:
+            try:
+                placed = sheet_placement.update_sheet_precise(self.session, df, target, field, value)
+            except Exception as e:
+                logger.error(f"Ошибка размещения {target}: {e}")
+                placed = False
+            self.session.record(target, placed)
+
+    def place_all(self, results):
+        """Готовые результаты {запрос: результат}: таблицы параллельно, внутри таблицы — по порядку реестра"""
+        self.session.load_mirror()
+        by_sink = {}
+        for query_name in config_placement.RESULT_PLACEMENTS:
+            if query_name in results:
+                for name, tasks in self.tasks(query_name, results[query_name]).items():
+                    by_sink.setdefault(name, []).extend(tasks)
+        if not self.parallel or len(by_sink) < 2:
+            for tasks in by_sink.values():
+                self._run(tasks)
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(by_sink), thread_name_prefix='sheets-sink') as executor:
+            list(executor.map(self._run, by_sink.values()))
+
+    def start(self):
+        """Потоковый режим: зеркало загружается в фоне, пока выполняются первые запросы"""
+        self._mirror_thread = threading.Thread(target=self.session.load_mirror, name='sheets-mirror', daemon=True)
+        self._mirror_thread.start()
+
+    def submit(self, query_name, df):
+        """Потоковый режим: размещения результата передаются писателям своих таблиц"""
+        for name, tasks in self.tasks(query_name, df).items():
+            key = name if self.parallel else None
+            if key not in self._queues:
+                self._queues[key] = queue.Queue()
+                writer = threading.Thread(target=self._writer, args=(self._queues[key],),
+                                          name=f"sheets-writer-{key or 'all'}", daemon=True)
+                writer.start()
+                self._writers.append(writer)
+            self._queues[key].put((query_name, tasks))
+
+    def _writer(self, pending):
+        self._mirror_thread.join()
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            query_name, tasks = item
+            self._run(tasks)
+            logger.info(f"Результат {query_name} размещен")
+
+    def join(self):
+        """Потоковый режим: дожидается записи всех переданных результатов"""
+        for pending in self._queues.values():
+            pending.put(None)
+        for writer in self._writers:
+            writer.join()
+        if self._mirror_thread is not None:
+            self._mirror_thread.join()
+        self._queues = {}
+        self._writers = []
+
+    def place_dependent(self):
+        """Зависимые размещения (DEPENDENT_PLACEMENTS), цели которых уже размещены"""
+        self.session.load_mirror()
+        for target, dependency in config_placement.DEPENDENT_PLACEMENTS.items():
+            if not self.session.placed.intersection(dependency['after']):
+                logger.warning(f"Размещение {target} пропущено: не размещена ни одна из целей {', '.join(dependency['after'])}")
+                continue
+            self.session.record(target, sheet_placement.update_sheet_precise(self.session, None, target, None))
@@ -15,14 +15,33 @@ SQL_QUERIES = {
                     status IN ('FINISHED') 
                     AND purpose IN ('PAYOUT', 'PARTNER_REWARD') 
                     AND sender_type IN ('WALLET', 'STOCK') 
-                    AND updated_at BETWEEN :start_week AND :end_week
+                    AND updated_at >= :start_week AND updated_at < :end_week
             )
             SELECT 
                 COUNT(*) AS total_payouts,
                 COUNT(*) FILTER (WHERE processing_time > '00:01:00') AS long_payouts
             FROM filtered_data;
         """,
-        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'}
+        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'},
+        # Необязательно: выполнять по дням параллельно и складывать результаты
+        'shard': 'day',
+        'combine': {'total_payouts': 'sum', 'long_payouts': 'sum'},
+        # Необязательно: описание для объединения с другими запросами по той же таблице и периоду
+        'scan': {
+            'source': 'your_schema.your_table',
+            'period_column': 'updated_at',
+            'where': "status IN ('FINISHED') AND purpose IN ('PAYOUT', 'PARTNER_REWARD') AND sender_type IN ('WALLET', 'STOCK')",
+            'aggregates': {
+                'total_payouts': 'COUNT(*)',
+                'long_payouts': "COUNT(*) FILTER (WHERE {where} AND processing_time > '00:01:00')",
+            },
+        },
+        'local': {
+            'extract': 'payouts',
+            'period_column': 'updated_at',
+            'where': "status == 'FINISHED' and purpose in ['PAYOUT', 'PARTNER_REWARD'] and sender_type in ['WALLET', 'STOCK']",
+            'aggregates': {'total_payouts': 'count', 'long_payouts': ('count', "processing_time > '00:01:00'")},
+        },
     },
     'tf_sr_partner_liability': {
         'query': """
@@ -34,13 +53,30 @@ SQL_QUERIES = {
                 status = 'FINISHED' 
                 AND purpose IN ('PAYOUT') 
                 AND sender_type IN ('PARTNER_LIABILITY') 
-                AND updated_at BETWEEN :start_week AND :end_week;
+                AND updated_at >= :start_week AND updated_at < :end_week;
         """,
-        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'}
+        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'},
+        'scan': {
+            'source': 'your_schema.your_table',
+            'period_column': 'updated_at',
+            'where': "status = 'FINISHED' AND purpose IN ('PAYOUT') AND sender_type IN ('PARTNER_LIABILITY')",
+            'aggregates': {
+                'total_payouts': 'COUNT(*)',
+                'long_payouts': "COUNT(*) FILTER (WHERE {where} AND updated_at - created_at > '00:01:00')",
+            },
+        },
+        'local': {
+            'extract': 'payouts',
+            'period_column': 'updated_at',
+            'where': "status == 'FINISHED' and purpose == 'PAYOUT' and sender_type == 'PARTNER_LIABILITY'",
+            'aggregates': {'total_payouts': 'count', 'long_payouts': ('count', "(updated_at - created_at) > '00:01:00'")},
+        },
     },
     'tf_sr_submitted_to_finished': {
         'query': """
-            SELECT AVG(finished_time - submitted_time) AS avg_duration 
+            SELECT 
+                AVG(finished_time - submitted_time) AS avg_duration,
+                COUNT(finished_time - submitted_time) AS cnt
             FROM (
                 SELECT 
                     submitted_time, 
@@ -48,26 +84,65 @@ SQL_QUERIES = {
                 FROM your_schema.your_table
                 WHERE 
                     status = 'FINISHED' 
-                    AND created_at BETWEEN :start_week AND :end_week
+                    AND created_at >= :start_week AND created_at < :end_week
             ) subq;
         """,
-        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'}
+        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'},
+        # AVG объединяется средним, взвешенным по количеству строк шарда
+        'shard': 'day',
+        'combine': {'avg_duration': ('mean', 'cnt'), 'cnt': 'sum'},
+        'scan': {
+            'source': 'your_schema.your_table',
+            'period_column': 'created_at',
+            'where': "status = 'FINISHED'",
+            'aggregates': {
+                'avg_duration': 'AVG(finished_time - submitted_time)',
+                'cnt': 'COUNT(finished_time - submitted_time)',
+            },
+        },
+        'local': {
+            'extract': 'payouts',
+            'period_column': 'created_at',
+            'where': "status == 'FINISHED'",
+            'aggregates': {'avg_duration': ('mean', 'finished_time - submitted_time'), 'cnt': 'count'},
+        },
     },
     'tf_sr_median_payouts': {
         'query': """
             SELECT 
                 PERCENTILE_CONT(0.5) WITHIN GROUP(ORDER BY processing_duration) AS median_duration
+            FROM your_schema.your_table
+            WHERE 
+                created_at >= :start_week AND created_at < :end_week
+                AND status = 'FINISHED';
+        """,
+        # Запрос шарда: медианы шардов не объединяются, поэтому шард возвращает скетч —
+        # 100 центроидов (среднее корзины, размер корзины), медиана считается после слияния (t-digest)
+        'shard_query': """
+            SELECT 
+                AVG(processing_duration) AS median_duration,
+                COUNT(*) AS centroid_weight
             FROM (
                 SELECT 
-                    id,
-                    processing_duration
+                    processing_duration,
+                    NTILE(100) OVER (ORDER BY processing_duration) AS bucket
                 FROM your_schema.your_table
                 WHERE 
-                    created_at BETWEEN :start_week AND :end_week
+                    created_at >= :start_week AND created_at < :end_week
                     AND status = 'FINISHED'
-            ) subq;
+            ) subq
+            GROUP BY bucket;
         """,
-        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'}
+        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'},
+        'shard': 'day',
+        'combine': {'median_duration': ('quantile', 0.5, 'centroid_weight'), 'centroid_weight': 'sum'},
+        # Локально медиана точная, без скетча
+        'local': {
+            'extract': 'payouts',
+            'period_column': 'created_at',
+            'where': "status == 'FINISHED'",
+            'aggregates': {'median_duration': ('median', 'processing_duration')},
+        },
     },
     'statuses_payout_reward': {
         'query': """
@@ -96,7 +171,22 @@ SQL_QUERIES = {
                 created_at BETWEEN :start_week AND :end_week
                 AND status = 'FINISHED';
         """,
-        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'}
+        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'},
+        'scan': {
+            'source': 'your_schema.your_table',
+            'period_column': 'created_at',
+            'where': "status = 'FINISHED'",
+            'aggregates': {
+                'long_count': "ROUND(COUNT(*) FILTER (WHERE {where} AND processing_time > threshold)::numeric * 100.0 "
+                              "/ NULLIF(COUNT(*) FILTER (WHERE {where}), 0)::numeric, 2)::text || '%'",
+            },
+        },
+        'local': {
+            'extract': 'payouts',
+            'period_column': 'created_at',
+            'where': "status == 'FINISHED'",
+            'aggregates': {'long_count': ('percent', 'processing_time > threshold')},
+        },
     },
     'currency_stats': {
         'query': """
@@ -104,13 +194,30 @@ SQL_QUERIES = {
                 currency,
                 COUNT(*) AS cnt_total,
                 AVG(processing_time) AS avg_time,
+                -- Точная медиана: запрос не шардируется и не хранится в дневных агрегатах,
+                -- поэтому скетч (как у tf_sr_median_payouts) ему не нужен
                 PERCENTILE_CONT(0.5) WITHIN GROUP(ORDER BY processing_time) AS median_time
             FROM your_schema.your_table
             WHERE created_at BETWEEN :start_week AND :end_week
             GROUP BY currency
             ORDER BY cnt_total DESC;
         """,
-        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'}
+        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'},
+        # Необязательно: statement_timeout запроса в секундах, по истечении запрос отменяется
+        'timeout': 900,
+        # Необязательно: читать серверным курсором и вставлять в лист по 5000 строк
+        'chunksize': 5000,
+        'local': {
+            'extract': 'payouts',
+            'period_column': 'created_at',
+            'group_by': ['currency'],
+            'order_by': {'cnt_total': 'desc'},
+            'aggregates': {
+                'cnt_total': 'count',
+                'avg_time': ('mean', 'processing_time'),
+                'median_time': ('median', 'processing_time'),
+            },
+        },
     },
     'statuses_partner_liability': {
         'query': """
@@ -130,6 +237,24 @@ SQL_QUERIES = {
                     AND sender_type = 'PARTNER_LIABILITY'
             ) subq;
         """,
+        'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'},
+        'timeout': 900,
+    }
+}
+
+# Raw extracts for local KPI calculation (EXECUTION_SETTINGS['local_metrics']):
+# minimal columns for the week, queries with 'local': {'extract': ...} are computed from them
+RAW_EXTRACTS = {
+    'payouts': {
+        'query': """
+            SELECT 
+                created_at, updated_at, status, purpose, sender_type, currency,
+                processing_time, processing_duration, threshold, submitted_time, finished_time
+            FROM your_schema.your_table
+            WHERE 
+                (created_at >= :start_week AND created_at < :end_week)
+                OR (updated_at >= :start_week AND updated_at < :end_week);
+        """,
         'params': {'start_week': ':start_week', 'end_week': ':end_week_exclusive'}
     }
 }
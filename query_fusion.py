@@ -0,0 +1,175 @@
+import logging
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Разделитель имени запроса и колонки в колонках объединённого запроса
+COLUMN_SEPARATOR = '__'
+
+
+def fuse_queries(queries_with_params, query_specs):
+    """Объединяет запросы, сканирующие одну таблицу за один период, в один проход.
+
+    Запрос участвует, если объявляет 'scan': {'source', 'period_column', 'where', 'aggregates'}.
+    Запросы с одинаковыми source, period_column и параметрами заменяются одним запросом
+    'scan:<source>:<period_column>' с агрегатами FILTER (WHERE ...), колонки которого
+    называются '<запрос>__<колонка>'.
+    Возвращает (запросы, описания запросов, {имя объединённого запроса: [имена запросов]}).
+    """
+    groups = {}
+    for name, (query, params) in queries_with_params.items():
+        scan = query_specs.get(name, {}).get('scan')
+        if not scan:
+            continue
+        key = (scan['source'], scan['period_column'], frozenset((params or {}).items()))
+        groups.setdefault(key, []).append(name)
+
+    queries = dict(queries_with_params)
+    specs = dict(query_specs)
+    fused = {}
+    for (source, period_column, _), names in groups.items():
+        if len(names) < 2:
+            continue
+        fused_name = f"scan:{source}:{period_column}"
+        params = queries_with_params[names[0]][1]
+        queries[fused_name] = (build_fused_query(names, query_specs), params)
+        specs[fused_name] = fused_spec(names, query_specs)
+        for name in names:
+            del queries[name]
+        fused[fused_name] = names
+        logger.info(f"Запросы {', '.join(names)} объединены в один проход по {source} ({period_column})")
+    return queries, specs, fused
+
+
+def _period_params(spec):
+    placeholders = spec.get('params', {})
+    start_param = next((param for param, value in placeholders.items() if value == ':start_week'), None)
+    end_param = next((param for param, value in placeholders.items() if value == ':end_week_exclusive'), None)
+    if not start_param or not end_param:
+        raise ValueError("для объединения нужны параметры ':start_week' и ':end_week_exclusive'")
+    return start_param, end_param
+
+
+def fused_aggregate(expression, where):
+    """Агрегат с фильтром запроса: подставляется в {where} или добавляется как FILTER (WHERE ...)"""
+    predicate = f"({where})" if where else 'TRUE'
+    if '{where}' in expression:
+        return expression.replace('{where}', predicate)
+    if not where:
+        return expression
+    return f"{expression} FILTER (WHERE {predicate})"
+
+
+def build_fused_query(names, query_specs):
+    """SQL одного прохода по таблице с агрегатами всех запросов группы.
+
+    Период фильтруется полуоткрыто (>= начало AND < конец) по period_column;
+    общий WHERE — объединение (OR) фильтров запросов, если фильтр есть у каждого.
+    """
+    first = query_specs[names[0]]['scan']
+    start_param, end_param = _period_params(query_specs[names[0]])
+    columns = []
+    filters = []
+    for name in names:
+        scan = query_specs[name]['scan']
+        where = scan.get('where')
+        filters.append(where)
+        for column, expression in scan['aggregates'].items():
+            columns.append(f'{fused_aggregate(expression, where)} AS "{name}{COLUMN_SEPARATOR}{column}"')
+
+    conditions = [f"{first['period_column']} >= :{start_param}", f"{first['period_column']} < :{end_param}"]
+    if all(filters):
+        conditions.append('(' + ' OR '.join(f"({where})" for where in dict.fromkeys(filters)) + ')')
+    return (
+        "SELECT\n    " + ",\n    ".join(columns) +
+        f"\nFROM {first['source']}\nWHERE " + "\n    AND ".join(conditions)
+    )
+
+
+def fused_spec(names, query_specs):
+    """Описание объединённого запроса: шардирование — только если все запросы шардируются одинаково.
+
+    Таймаут — наибольший из таймаутов запросов группы (если он задан у каждого).
+    """
+    spec = dict(query_specs[names[0]])
+    spec.pop('scan', None)
+    spec.pop('combine', None)
+    spec.pop('timeout', None)
+    timeouts = [query_specs[name].get('timeout') for name in names]
+    if all(timeouts):
+        spec['timeout'] = max(timeouts)
+    shards = {query_specs[name].get('shard') for name in names}
+    if len(shards) != 1 or None in shards:
+        spec.pop('shard', None)
+        return spec
+
+    combine = {}
+    for name in names:
+        for column, combiner in query_specs[name].get('combine', {}).items():
+            if isinstance(combiner, tuple):
+                # Колонка веса ('mean', w) / ('quantile', q, w) тоже переименовывается
+                combiner = combiner[:-1] + (f"{name}{COLUMN_SEPARATOR}{combiner[-1]}",)
+            combine[f"{name}{COLUMN_SEPARATOR}{column}"] = combiner
+    spec['combine'] = combine
+    return spec
+
+
+def split_fused_result(df, names):
+    """Раздаёт колонки результата объединённого запроса исходным запросам: {имя: DataFrame}.
+
+    Результат, уже разложенный по запросам ({имя: DataFrame}), раздаётся как есть.
+    """
+    if isinstance(df, dict):
+        return {name: df.get(name, pd.DataFrame()) for name in names}
+    results = {}
+    for name in names:
+        prefix = f"{name}{COLUMN_SEPARATOR}"
+        columns = [column for column in df.columns if column.startswith(prefix)]
+        results[name] = df[columns].rename(columns=lambda column: column[len(prefix):]) if columns else pd.DataFrame()
+    return results
+
+
+def fan_out(results, fused):
+    """Пары (имя, результат), где результаты объединённых запросов разложены по исходным именам"""
+    for name, df in results:
+        if name not in fused:
+            yield name, df
+            continue
+        for member, member_df in split_fused_result(df, fused[name]).items():
+            yield member, member_df
+
+
+def build_grouped_query(spec, bucket='week'):
+    """SQL запроса со 'scan' за весь период с группировкой по date_trunc(bucket, period_column).
+
+    Колонка 'period_start' — начало периода группы; остальные колонки те же, что у запроса.
+    Используется для пересчёта нескольких недель одним запросом вместо запуска на каждую неделю.
+    """
+    scan = spec['scan']
+    start_param, end_param = _period_params(spec)
+    period_column = scan['period_column']
+    columns = [f"date_trunc('{bucket}', {period_column}) AS period_start"]
+    columns += [f'{fused_aggregate(expression, None)} AS "{column}"' for column, expression in scan['aggregates'].items()]
+    conditions = [f"{period_column} >= :{start_param}", f"{period_column} < :{end_param}"]
+    if scan.get('where'):
+        conditions.append(f"({scan['where']})")
+    return (
+        "SELECT\n    " + ",\n    ".join(columns) +
+        f"\nFROM {scan['source']}\nWHERE " + "\n    AND ".join(conditions) +
+        "\nGROUP BY 1\nORDER BY 1"
+    )
+
+
+def split_grouped_result(df, period_starts):
+    """Результат build_grouped_query по периодам: {начало периода 'YYYY-MM-DD': DataFrame из одной строки}.
+
+    Период без строк (нет данных) получает пустой DataFrame.
+    """
+    frames = {start: pd.DataFrame() for start in period_starts}
+    if df is None or df.empty or 'period_start' not in df.columns:
+        return frames
+    for _, row in df.iterrows():
+        start = pd.Timestamp(row['period_start']).strftime('%Y-%m-%d')
+        if start in frames:
+            frames[start] = row.drop('period_start').to_frame().T.reset_index(drop=True).infer_objects()
+    return frames
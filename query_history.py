@@ -0,0 +1,100 @@
+import heapq
+import json
+import logging
+import os
+import threading
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class QueryHistory:
+    """История длительностей задач выполнения (JSON на диске) для планирования longest-job-first.
+
+    Для каждой задачи хранится сглаженная (EWMA) длительность в секундах. Шарды запроса
+    учитываются под общим ключом '<запрос>@shard', пакеты однострочных запросов —
+    под 'batch:<имена>'. Задачи короче min_seconds (попадания в кэш, мгновенные запросы)
+    не записываются: на порядок выполнения они не влияют, а прогноз бы занижали.
+    """
+
+    def __init__(self, path, alpha=0.3, min_seconds=0.5):
+        self.path = path
+        self.alpha = alpha
+        self.min_seconds = min_seconds
+        self.durations = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    @classmethod
+    def from_config(cls):
+        """История из config.QUERY_HISTORY или None, если она выключена"""
+        settings = getattr(config, 'QUERY_HISTORY', {})
+        if not settings.get('enabled', False):
+            return None
+        return cls(settings.get('path', 'kpi_query_history.json'), settings.get('alpha', 0.3),
+                   settings.get('min_seconds', 0.5))
+
+    @staticmethod
+    def key(name):
+        """Ключ истории: шарды запроса (name@период) делят один ключ"""
+        return f"{name.split('@', 1)[0]}@shard" if '@' in name else name
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.durations = {name: float(seconds) for name, seconds in json.load(f).items()}
+        except FileNotFoundError:
+            self.durations = {}
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать историю запросов {self.path}: {e}")
+            self.durations = {}
+
+    def expected(self, name):
+        """Ожидаемая длительность задачи в секундах или None, если истории нет"""
+        return self.durations.get(self.key(name))
+
+    def record(self, name, seconds):
+        if seconds < self.min_seconds:
+            return
+        key = self.key(name)
+        with self._lock:
+            previous = self.durations.get(key)
+            self.durations[key] = seconds if previous is None else previous + self.alpha * (seconds - previous)
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with self._lock, open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(dict(sorted(self.durations.items())), f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить историю запросов {self.path}: {e}")
+
+    def order(self, names):
+        """Имена задач в порядке запуска: сначала без истории (могут быть долгими), затем по убыванию длительности.
+
+        Порядок задач с одинаковым ключом сортировки сохраняется.
+        """
+        def sort_key(name):
+            seconds = self.expected(name)
+            return (seconds is not None, -(seconds or 0))
+        return sorted(names, key=sort_key)
+
+    def estimate(self, names, workers):
+        """Прогноз (время выполнения, самая долгая задача, её длительность, задач без истории).
+
+        Время выполнения — жадное расписание по потокам в порядке order(); задачи без истории
+        оцениваются медианой известных длительностей.
+        """
+        known = sorted(seconds for seconds in map(self.expected, names) if seconds is not None)
+        fallback = known[len(known) // 2] if known else 0.0
+        loads = [0.0] * max(workers, 1)
+        longest_name, longest = None, 0.0
+        for name in self.order(names):
+            seconds = self.expected(name)
+            seconds = fallback if seconds is None else seconds
+            if seconds > longest:
+                longest_name, longest = name, seconds
+            heapq.heapreplace(loads, loads[0] + seconds)
+        unknown = sum(1 for name in names if self.expected(name) is None)
+        return max(loads), longest_name, longest, unknown
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+import pandas as pd
+import config
+
+logger = logging.getLogger(__name__)
+
+# Режимы кэша: use — читать и писать, refresh — не читать, но перезаписать, bypass — не трогать
+CACHE_MODES = ('use', 'refresh', 'bypass')
+
+
+class ResultCache:
+    """Кэш результатов запросов на диске для закрытых отчётных периодов.
+
+    Ключ — хэш от (имя запроса, текст SQL, параметры); результат хранится в Parquet
+    с сохранением типов колонок (включая timedelta). Размер ограничен max_bytes,
+    вытесняются давно не использованные файлы (LRU по времени изменения).
+    Запросы за период, который ещё не закончился, не кэшируются.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, mode='use'):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Неизвестный режим кэша: {mode}")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, mode=None):
+        settings = getattr(config, 'RESULT_CACHE', {})
+        if not settings.get('enabled', True) and mode is None:
+            mode = 'bypass'
+        return cls(
+            settings.get('directory', '.kpi_cache'),
+            settings.get('max_bytes', 512 * 1024 * 1024),
+            mode or 'use',
+        )
+
+    @staticmethod
+    def key(query_name, query, params):
+        payload = json.dumps({'name': query_name, 'query': query, 'params': params or {}}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def is_closed_period(params, now=None):
+        """Период закрыт, если все даты и моменты в параметрах уже наступили (конец периода исключающий).
+
+        Сравниваются полные моменты времени: дата без времени — это её полночь, поэтому неделя
+        с концом сегодня закрыта, а часовой шард сегодняшнего дня — только после конца часа.
+        """
+        now = now or datetime.now()
+        moments = []
+        for value in (params or {}).values():
+            try:
+                moment = datetime.fromisoformat(str(value))
+            except ValueError:
+                continue
+            if moment.tzinfo is not None:
+                moment = moment.astimezone().replace(tzinfo=None)
+            moments.append(moment)
+        return bool(moments) and max(moments) <= now
+
+    def accepts(self, params):
+        return self.mode != 'bypass' and self.is_closed_period(params)
+
+    def _path(self, query_name, key):
+        safe_name = re.sub(r'[^\w@.-]', '_', query_name)
+        return os.path.join(self.directory, f"{safe_name}-{key}.parquet")
+
+    def get(self, query_name, key):
+        if self.mode != 'use':
+            return None
+        path = self._path(query_name, key)
+        try:
+            df = pd.read_parquet(path)
+        except FileNotFoundError:
+            self._count('misses')
+            return None
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать кэш {path}: {e}")
+            self._count('misses')
+            return None
+        os.utime(path)  # отметка использования для LRU
+        self._count('hits')
+        return df
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def put(self, query_name, key, df):
+        if self.mode == 'bypass':
+            return
+        path = self._path(query_name, key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            # Каталог создаётся при первой записи: в режиме bypass он не нужен
+            os.makedirs(self.directory, exist_ok=True)
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить {query_name} в кэш: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for name in os.listdir(self.directory):
+            if name.endswith('.parquet'):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def _evict(self):
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                os.remove(path)
+                total -= size
+                logger.info(f"Кэш: вытеснен {os.path.basename(path)}")
+
+    def invalidate(self, query_name=None):
+        """Удаляет записи кэша: все или только для запроса query_name (включая его шарды)"""
+        removed = 0
+        with self._lock:
+            for _, _, path in self._entries():
+                name = os.path.basename(path)
+                if query_name is None or name.startswith(f"{query_name}-") or name.startswith(f"{query_name}@"):
+                    os.remove(path)
+                    removed += 1
+        logger.info(f"Кэш: удалено записей {removed}")
+        return removed
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+from datetime import date, datetime
+from decimal import Decimal
+import pandas as pd
+import config
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS rollups (
+        query_name TEXT NOT NULL,
+        day TEXT NOT NULL,
+        version TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (query_name, day)
+    )
+"""
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def encode_frame(df):
+    """DataFrame -> JSON: timedelta хранится в секундах, список таких колонок пишется рядом"""
+    data = df.copy()
+    timedelta_columns = []
+    for column in data.columns:
+        values = data[column].dropna()
+        if pd.api.types.is_timedelta64_dtype(data[column]) or (len(values) and hasattr(values.iloc[0], 'total_seconds')):
+            data[column] = pd.to_timedelta(data[column]).dt.total_seconds()
+            timedelta_columns.append(str(column))
+    rows = data.astype(object).where(data.notna(), None).values.tolist()
+    return json.dumps({'columns': [str(column) for column in data.columns], 'timedelta': timedelta_columns, 'rows': rows},
+                      default=_json_default)
+
+
+def decode_frame(payload):
+    data = json.loads(payload)
+    df = pd.DataFrame(data['rows'], columns=data['columns'])
+    for column in data['timedelta']:
+        df[column] = pd.to_timedelta(df[column], unit='s')
+    return df
+
+
+class RollupStore:
+    """Локальное хранилище дневных частичных агрегатов (SQLite).
+
+    Для каждого запроса и закрытого дня хранится результат дневного шарда — счётчики, суммы,
+    центроиды скетча медианы, — из которого недельные (и любые другие) периоды собираются
+    комбинаторами запроса без обращения к БД. Версия записи — хэш текста SQL: после изменения
+    запроса старые дни считаются отсутствующими и пересчитываются.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reused = 0
+        self.stored = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(SCHEMA)
+
+    @classmethod
+    def from_config(cls):
+        """Хранилище из config.ROLLUP_STORE или None, если оно выключено"""
+        settings = getattr(config, 'ROLLUP_STORE', {})
+        if not settings.get('enabled', False):
+            return None
+        return cls(settings.get('path', 'kpi_rollups.sqlite3'))
+
+    @staticmethod
+    def version(query):
+        return hashlib.sha256(query.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def is_closed_day(day, today=None):
+        """День закрыт, если он целиком в прошлом"""
+        today = today or date.today()
+        return datetime.fromisoformat(str(day)).date() < today
+
+    def get(self, query_name, day, version):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT payload FROM rollups WHERE query_name = ? AND day = ? AND version = ?",
+                (query_name, str(day), version)).fetchone()
+        if row is None:
+            return None
+        self.reused += 1
+        return decode_frame(row[0])
+
+    def put(self, query_name, day, version, df):
+        """Сохраняет результат закрытого дня.
+
+        Пустой результат (тихий день) тоже сохраняется — как отметка, что день посчитан;
+        результаты с ошибкой вызывающий код сюда не передаёт.
+        """
+        if df is None or not self.is_closed_day(day):
+            return False
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO rollups (query_name, day, version, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                (query_name, str(day), version, encode_frame(df), datetime.now().isoformat(timespec='seconds')))
+        self.stored += 1
+        return True
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
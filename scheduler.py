@@ -1,13 +1,178 @@
-import schedule
-import time
-from auto_collect import main
+import argparse
+import json
 import logging
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+import schedule
+import config
+import database
+import sheets_gate
+from auto_collect import main, update_daily_rollups, get_google_sheet_client, check_sheets_client
+
+logger = logging.getLogger(__name__)
+
+
+def scheduler_settings():
+    return getattr(config, 'SCHEDULER', {})
+
+
+class Daemon:
+    """Долгоживущий процесс планировщика.
+
+    Движок БД и авторизованный клиент Sheets создаются один раз и переиспользуются между
+    запусками; перед каждым запуском они проверяются (SELECT 1, срок токена) и пересоздаются,
+    если проверка не прошла. Состояние запуска (строки недели, счётчики квоты) сбрасывает main.
+    Состояние процесса пишется в файл здоровья (SCHEDULER['health_file']) отдельным потоком
+    каждые check_interval секунд, в том числе во время долгого запуска. SIGTERM/SIGINT
+    останавливают планировщик после завершения текущего запуска.
+    """
+
+    def __init__(self, health_file=None):
+        self.health_file = health_file or scheduler_settings().get('health_file', 'kpi_scheduler_health.json')
+        self.engine = None
+        self.client = None
+        self.gate = None
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None  # {'started_at', 'finished_at', 'seconds', 'ok'}
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self._stop = threading.Event()
+        self._health_lock = threading.Lock()
+
+    def ensure_engine(self):
+        if self.engine is not None and database.check_connection(self.engine):
+            return self.engine
+        if self.engine is not None:
+            logger.warning("Соединение с БД потеряно, движок создаётся заново")
+            self.engine.dispose()
+        self.engine = database.create_db_connection()
+        return self.engine
+
+    def ensure_client(self):
+        if self.client is not None and check_sheets_client(self.client):
+            return self.client
+        self.gate = sheets_gate.RequestGate.from_config()
+        self.client = get_google_sheet_client(self.gate)
+        return self.client
+
+    def daily_job(self):
+        """Досчитать вчерашний день в хранилище агрегатов и собрать из него неделю"""
+        started_at = datetime.now().isoformat(timespec='seconds')
+        start = time.monotonic()
+        self.running = True
+        self.write_health()
+        ok = False
+        try:
+            engine = self.ensure_engine()
+            client = self.ensure_client()
+            if engine is None or client is None:
+                logger.error("Нет подключения к БД или Google Sheets, запуск пропущен")
+            else:
+                update_daily_rollups(engine=engine)
+                ok = main(engine=engine, client=client, gate=self.gate) is not None
+        except Exception as e:
+            logger.exception(f"Ошибка запуска по расписанию: {e}")
+        finally:
+            seconds = time.monotonic() - start
+            self.running = False
+            self.runs += 1
+            self.failures += 0 if ok else 1
+            self.last_run = {'started_at': started_at, 'finished_at': datetime.now().isoformat(timespec='seconds'),
+                             'seconds': round(seconds, 1), 'ok': ok}
+            logger.info(f"Запуск по расписанию {'завершен' if ok else 'завершился ошибкой'} за {seconds:.1f} с")
+            self.write_health()
+
+    def write_health(self, stopped=False):
+        """Состояние процесса для внешней проверки (scheduler.py --health)"""
+        next_run = schedule.next_run()
+        state = {
+            'pid': os.getpid(),
+            'started_at': self.started_at,
+            'updated_at': datetime.now().isoformat(timespec='seconds'),
+            'running': self.running,
+            'stopped': stopped,
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_run': self.last_run,
+            'next_run': next_run.isoformat(timespec='seconds') if next_run else None,
+        }
+        tmp_path = f"{self.health_file}.tmp"
+        try:
+            with self._health_lock:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(state, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.health_file)
+        except Exception as e:
+            logger.warning(f"Не удалось записать состояние планировщика {self.health_file}: {e}")
+
+    def heartbeat(self, interval):
+        """Поток файла здоровья: обновляет его, пока планировщик не остановлен"""
+        while not self._stop.wait(interval):
+            self.write_health()
+
+    def request_stop(self, signum, frame):
+        if self._stop.is_set():
+            # Повторный сигнал — выход без ожидания текущего запуска
+            raise SystemExit(1)
+        logger.info(f"Получен сигнал {signal.Signals(signum).name}, планировщик остановится после текущего запуска")
+        self._stop.set()
+
+    def run(self):
+        settings = scheduler_settings()
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        schedule.every().day.at(settings.get('run_at', '09:00')).do(self.daily_job)
+        logger.info(f"Планировщик запущен (pid {os.getpid()}), запуск ежедневно в {settings.get('run_at', '09:00')}")
+        interval = settings.get('check_interval', 60)
+        self.write_health()
+        threading.Thread(target=self.heartbeat, args=(interval,), name='scheduler-heartbeat', daemon=True).start()
+        try:
+            if settings.get('run_on_start', False):
+                self.daily_job()
+            while not self._stop.is_set():
+                schedule.run_pending()
+                self._stop.wait(interval)
+        finally:
+            schedule.clear()
+            if self.engine is not None:
+                self.engine.dispose()
+            self.write_health(stopped=True)
+            logger.info("Планировщик остановлен")
+
+
+def check_health(health_file=None):
+    """Код возврата для внешней проверки: 0 — процесс жив и последний запуск успешен, 1 — иначе.
 
-# Настройка планировщика
-schedule.every().day.at("09:00").do(main)  # Ежедневно в 9:00
+    Процесс считается живым, если файл состояния обновлялся не дольше трёх интервалов проверки
+    назад; файл обновляет отдельный поток, поэтому долгий запуск (running) живость не сбрасывает.
+    """
+    settings = scheduler_settings()
+    health_file = health_file or settings.get('health_file', 'kpi_scheduler_health.json')
+    try:
+        with open(health_file, encoding='utf-8') as f:
+            state = json.load(f)
+    except Exception as e:
+        print(f"Нет состояния планировщика {health_file}: {e}")
+        return 1
+    age = (datetime.now() - datetime.fromisoformat(state['updated_at'])).total_seconds()
+    alive = not state.get('stopped') and age <= 3 * settings.get('check_interval', 60)
+    last_ok = state.get('last_run') is None or state['last_run']['ok']
+    print(json.dumps(dict(state, age_seconds=round(age)), ensure_ascii=False, indent=2))
+    return 0 if alive and last_ok else 1
 
-logging.info("Планировщик запущен. Ожидание выполнения...")
 
-while True:
-    schedule.run_pending()
-    time.sleep(60)  # Проверяем каждую минуту
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Планировщик ежедневного сбора KPI")
+    parser.add_argument('--health', action='store_true', help="проверить состояние запущенного планировщика и выйти")
+    args = parser.parse_args()
+    if args.health:
+        sys.exit(check_health())
+    try:
+        Daemon().run()
+    finally:
+        logging.shutdown()
@@ -0,0 +1,374 @@
+import logging
+import re
+import threading
+import gspread
+from gspread.utils import absolute_range_name, a1_range_to_grid_range, rowcol_to_a1
+import config
+
+logger = logging.getLogger(__name__)
+
+# Чтение для проверки: формулы как текст, даты/время строкой, числа без форматирования
+VERIFY_READ_PARAMS = {'valueRenderOption': 'FORMULA', 'dateTimeRenderOption': 'FORMATTED_STRING'}
+
+# Локализованные имена функций в формулах -> английские (API может вернуть любой вариант)
+FORMULA_FUNCTION_ALIASES = {'ОКРУГЛ': 'ROUND'}
+
+TIMEDELTA_PATTERN = re.compile(r'^(?:(-?\d+) days?,? )?(-?\d+):(\d{2}):(\d{2})(?:[.,](\d+))?$')
+
+
+def normalize_cell_value(value):
+    """Приводит значение ячейки к сравнимому виду.
+
+    Длительности ('00:01:42,033043', '1 day, 02:00:00') -> секунды, проценты и числа
+    с запятой -> float, формулы -> верхний регистр без пробелов с английскими именами функций.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    text = str(value).strip()
+    if text.startswith("'"):
+        text = text[1:]
+    if text.startswith('='):
+        formula = text.upper().replace(' ', '')
+        for alias, name in FORMULA_FUNCTION_ALIASES.items():
+            formula = formula.replace(alias, name)
+        formula = formula.replace(';', ',')
+        return re.sub(r'(?<=\d),(?=\d)', '.', formula)
+    match = TIMEDELTA_PATTERN.match(text)
+    if match:
+        days, hours, minutes, seconds, fraction = match.groups()
+        total = int(days or 0) * 86400 + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+        if fraction:
+            total += float(f"0.{fraction}")
+        return float(total)
+    number = text.replace(',', '.')
+    try:
+        if number.endswith('%'):
+            return float(number[:-1]) / 100
+        return float(number)
+    except ValueError:
+        return text
+
+
+def values_match(expected, actual):
+    """Сравнение записанного и прочитанного значения после нормализации"""
+    expected = normalize_cell_value(expected)
+    actual = normalize_cell_value(actual)
+    if isinstance(expected, float) and isinstance(actual, float):
+        return abs(expected - actual) <= 1e-6 * max(1.0, abs(expected))
+    return expected == actual
+
+
+class WritePlan:
+    """План записей в Google Sheets на один запуск.
+
+    Размещение добавляет в план тройки (ячейка/диапазон, значения, RAW/USER_ENTERED),
+    а flush() отправляет их одним values:batchUpdate на таблицу (отдельный запрос
+    нужен только для второго value_input_option, если в таблице есть оба).
+    """
+
+    def __init__(self):
+        self.spreadsheets = {}  # spreadsheet_id -> Spreadsheet
+        self.entries = {}       # spreadsheet_id -> [{'range', 'values', 'value_input_option'}]
+        self.clears = {}        # spreadsheet_id -> [имена листов для полной очистки]
+        self.requests = {}      # spreadsheet_id -> [запросы spreadsheets.batchUpdate, (диапазон, значения)]
+        self.flushed = {}       # spreadsheet_id -> отправленные записи (для verify)
+
+    def _register(self, worksheet):
+        spreadsheet = worksheet.spreadsheet
+        self.spreadsheets.setdefault(spreadsheet.id, spreadsheet)
+        return spreadsheet.id
+
+    def add(self, worksheet, cell_range, values, value_input_option='RAW'):
+        """Добавляет запись диапазона в план"""
+        spreadsheet_id = self._register(worksheet)
+        entry = {
+            'range': absolute_range_name(worksheet.title, cell_range),
+            'values': values,
+            'value_input_option': value_input_option,
+        }
+        self.entries.setdefault(spreadsheet_id, []).append(entry)
+        if config.SHEETS_DEBUG.get('log_ranges'):
+            logger.info(f"plan += {entry['range']} ({value_input_option}) values={values}")
+
+    def clear(self, worksheet):
+        """Добавляет в план полную очистку листа (выполняется до записи значений)"""
+        spreadsheet_id = self._register(worksheet)
+        self.clears.setdefault(spreadsheet_id, []).append(absolute_range_name(worksheet.title))
+        if config.SHEETS_DEBUG.get('log_ranges'):
+            logger.info(f"plan += clear {worksheet.title}")
+
+    def add_requests(self, worksheet, requests, expected=None):
+        """Добавляет запросы spreadsheets.batchUpdate (сдвиги, updateCells).
+
+        Все запросы таблицы уходят одним атомарным batchUpdate до записи значений.
+        expected — [(A1-диапазон, значения)], которые попадут в отложенную проверку.
+        """
+        spreadsheet_id = self._register(worksheet)
+        pending = self.requests.setdefault(spreadsheet_id, [[], []])
+        pending[0].extend(requests)
+        for cell_range, values in expected or []:
+            pending[1].append({
+                'range': absolute_range_name(worksheet.title, cell_range),
+                'values': values,
+                'value_input_option': 'RAW',
+            })
+        if config.SHEETS_DEBUG.get('log_ranges'):
+            logger.info(f"plan += {len(requests)} batchUpdate-запросов для {worksheet.title}")
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+    def calls(self, spreadsheet_id):
+        """Запросы плана для таблицы в порядке отправки: [(метод API, тело запроса)].
+
+        Метод — суффикс URL таблицы: ':batchUpdate' (сдвиги, updateCells), '/values:batchClear',
+        '/values:batchUpdate' (по одному на value_input_option).
+        """
+        requests, _ = self.requests.get(spreadsheet_id, [[], []])
+        clears = self.clears.get(spreadsheet_id, [])
+        by_option = {}
+        for entry in self.entries.get(spreadsheet_id, []):
+            by_option.setdefault(entry['value_input_option'], []).append(
+                {'range': entry['range'], 'values': entry['values']})
+
+        calls = []
+        if requests:
+            calls.append((':batchUpdate', {'requests': requests}))
+        if clears:
+            calls.append(('/values:batchClear', {'ranges': clears}))
+        for value_input_option, data in by_option.items():
+            calls.append(('/values:batchUpdate', {'valueInputOption': value_input_option, 'data': data}))
+        return calls
+
+    def log_spreadsheet(self, spreadsheet_id):
+        """Пишет в лог объём записи в таблицу (и диапазоны при SHEETS_DEBUG['log_ranges'])"""
+        entries = self.entries.get(spreadsheet_id, [])
+        logger.info(f"Пакетная запись в {spreadsheet_id}: {len(entries)} диапазонов, "
+                    f"очистка листов: {len(self.clears.get(spreadsheet_id, []))}, "
+                    f"batchUpdate-запросов: {len(self.requests.get(spreadsheet_id, [[], []])[0])}")
+        if config.SHEETS_DEBUG.get('log_ranges'):
+            for entry in entries:
+                logger.info(f"batch -> {entry['range']} ({entry['value_input_option']}) values={entry['values']}")
+
+    def mark_flushed(self, spreadsheet_id, method=None):
+        """Отмечает отправленное в отложенную проверку: ожидаемые ячейки batchUpdate (method=':batchUpdate')
+        или, по умолчанию, все записи значений таблицы"""
+        if method == ':batchUpdate':
+            self.flushed.setdefault(spreadsheet_id, []).extend(self.requests.get(spreadsheet_id, [[], []])[1])
+        elif method is None:
+            self.flushed.setdefault(spreadsheet_id, []).extend(self.entries.get(spreadsheet_id, []))
+
+    def reset(self):
+        """Очищает план после отправки"""
+        self.entries = {}
+        self.clears = {}
+        self.requests = {}
+
+    def flush(self):
+        """Отправляет накопленный план: по одному batchUpdate на таблицу"""
+        if not self.entries and not self.clears and not self.requests:
+            logger.info("План записи пуст")
+            return True
+
+        success = True
+        for spreadsheet_id in list(self.spreadsheets):
+            self.log_spreadsheet(spreadsheet_id)
+            if config.SHEETS_DEBUG.get('dry_run'):
+                continue
+
+            spreadsheet = self.spreadsheets[spreadsheet_id]
+            try:
+                for method, body in self.calls(spreadsheet_id):
+                    if method == ':batchUpdate':
+                        spreadsheet.batch_update(body)
+                    elif method == '/values:batchClear':
+                        spreadsheet.values_batch_clear(body=body)
+                    else:
+                        spreadsheet.values_batch_update(body=body)
+                        logger.info(f"values:batchUpdate {spreadsheet_id} ({body['valueInputOption']}): "
+                                    f"{len(body['data'])} диапазонов")
+                    self.mark_flushed(spreadsheet_id, method)
+                self.mark_flushed(spreadsheet_id)
+            except Exception as e:
+                logger.error(f"Ошибка пакетной записи в таблицу {spreadsheet_id}: {e}")
+                success = False
+
+        self.reset()
+        return success
+
+    def verify(self):
+        """Отложенная проверка: читает все отправленные ячейки одним batchGet на таблицу.
+
+        Возвращает список расхождений (ячейка, ожидалось, в таблице) и пишет краткий отчёт в лог.
+        """
+        mismatches = []
+        checked = 0
+        for spreadsheet_id, entries in self.flushed.items():
+            # Ожидаемое значение по ячейке: более поздняя запись перекрывает раннюю
+            expected = {}
+            for entry in entries:
+                title, _, a1 = entry['range'].rpartition('!')
+                grid = a1_range_to_grid_range(a1)
+                for i, row in enumerate(entry['values']):
+                    for j, value in enumerate(row):
+                        cell = rowcol_to_a1(grid.get('startRowIndex', 0) + i + 1, grid.get('startColumnIndex', 0) + j + 1)
+                        expected[f"{title}!{cell}"] = value
+
+            ranges = list(dict.fromkeys(entry['range'] for entry in entries))
+            try:
+                response = self.spreadsheets[spreadsheet_id].values_batch_get(ranges, params=VERIFY_READ_PARAMS)
+            except Exception as e:
+                logger.error(f"verify: ошибка чтения таблицы {spreadsheet_id}: {e}")
+                continue
+
+            actual = {}
+            for range_name, value_range in zip(ranges, response.get('valueRanges', [])):
+                title, _, a1 = range_name.rpartition('!')
+                grid = a1_range_to_grid_range(a1)
+                for i, row in enumerate(value_range.get('values', [])):
+                    for j, value in enumerate(row):
+                        cell = rowcol_to_a1(grid.get('startRowIndex', 0) + i + 1, grid.get('startColumnIndex', 0) + j + 1)
+                        actual[f"{title}!{cell}"] = value
+
+            for cell, value in expected.items():
+                checked += 1
+                back = actual.get(cell, '')
+                if not values_match(value, back):
+                    mismatches.append((cell, value, back))
+
+        logger.info(f"verify: проверено {checked} ячеек, расхождений: {len(mismatches)}")
+        for cell, value, back in mismatches:
+            logger.warning(f"verify mismatch {cell}: ожидалось '{value}', в таблице '{back}'")
+        return mismatches
+
+
+class PreloadedSpreadsheet(gspread.Spreadsheet):
+    """Таблица gspread, список листов которой берётся из метаданных, полученных при открытии.
+
+    Конструктор gspread уже запрашивает метаданные таблицы (вместе со списком листов),
+    а worksheets() запросил бы их ещё раз: первый вызов после открытия использует
+    сохранённый ответ, последующие идут в API как обычно.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._opening = True
+        self._opening_metadata = None
+        super().__init__(*args, **kwargs)
+        self._opening = False
+
+    def fetch_sheet_metadata(self, params=None, *args, **kwargs):
+        if params is None and self._opening_metadata is not None:
+            metadata, self._opening_metadata = self._opening_metadata, None
+            return metadata
+        metadata = super().fetch_sheet_metadata(params, *args, **kwargs)
+        if self._opening and params is None:
+            self._opening_metadata = metadata
+        return metadata
+
+
+class WorksheetCache:
+    """Кэш таблиц и листов на один запуск.
+
+    Ключ — реальный ID таблицы (после get_spreadsheet_id) и имя листа. Таблица и все её
+    листы загружаются одним запросом метаданных при первом обращении.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._spreadsheets = {}  # spreadsheet_id -> Spreadsheet
+        self._worksheets = {}    # spreadsheet_id -> {title: Worksheet}
+        self._lock = threading.Lock()
+
+    def spreadsheet(self, spreadsheet_id):
+        """Возвращает открытую таблицу, открывая её только при первом обращении"""
+        with self._lock:
+            return self._load(spreadsheet_id)
+
+    def worksheet(self, spreadsheet_id, sheet_name):
+        """Возвращает лист из кэша; WorksheetNotFound, если такого листа нет"""
+        with self._lock:
+            self._load(spreadsheet_id)
+            worksheets = self._worksheets[spreadsheet_id]
+            if sheet_name not in worksheets:
+                raise gspread.exceptions.WorksheetNotFound(sheet_name)
+            return worksheets[sheet_name]
+
+    def titles(self, spreadsheet_id):
+        """Имена всех листов таблицы"""
+        with self._lock:
+            self._load(spreadsheet_id)
+            return list(self._worksheets[spreadsheet_id])
+
+    def _load(self, spreadsheet_id):
+        if spreadsheet_id not in self._spreadsheets:
+            logger.info(f"Загружаем метаданные таблицы {spreadsheet_id}")
+            transport = getattr(self.client, 'http_client', self.client)  # gspread 6 / gspread 5
+            spreadsheet = PreloadedSpreadsheet(transport, {'id': spreadsheet_id})
+            # Листы — из метаданных, полученных при открытии, без второго запроса
+            self._worksheets[spreadsheet_id] = {ws.title: ws for ws in spreadsheet.worksheets()}
+            self._spreadsheets[spreadsheet_id] = spreadsheet
+        return self._spreadsheets[spreadsheet_id]
+
+
+class SheetMirror:
+    """Локальная копия нужных диапазонов листов на один запуск.
+
+    В начале запуска выбранные столбцы читаются одним values:batchGet на таблицу,
+    после чего поиск следующей строки и строки недели отвечаются из памяти.
+    Хранятся только непустые ячейки: {(строка, столбец): значение}, индексы с нуля.
+    """
+
+    def __init__(self):
+        self._cells = {}    # (spreadsheet_id, title) -> {(row, col): value}
+        self._loaded = set()  # (spreadsheet_id, title)
+
+    def load(self, spreadsheet, ranges_by_sheet):
+        """Читает диапазоны {лист: [A1-диапазоны]} одним batchGet; пустой список — весь лист"""
+        ranges = []
+        for title, sheet_ranges in ranges_by_sheet.items():
+            if sheet_ranges:
+                ranges.extend(absolute_range_name(title, r) for r in sheet_ranges)
+            else:
+                ranges.append(absolute_range_name(title))
+        if not ranges:
+            return
+
+        logger.info(f"Зеркало листов {spreadsheet.id}: читаем {len(ranges)} диапазонов одним batchGet")
+        response = spreadsheet.values_batch_get(ranges)
+        for value_range in response.get('valueRanges', []):
+            title, grid = self._parse_range(value_range['range'])
+            key = (spreadsheet.id, title)
+            cells = self._cells.setdefault(key, {})
+            self._loaded.add(key)
+            row0 = grid.get('startRowIndex', 0)
+            col0 = grid.get('startColumnIndex', 0)
+            for i, row in enumerate(value_range.get('values', [])):
+                for j, cell in enumerate(row):
+                    if cell != '':
+                        cells[(row0 + i, col0 + j)] = cell
+
+    @staticmethod
+    def _parse_range(range_name):
+        title, _, a1 = range_name.rpartition('!')
+        if not title:
+            # Диапазон без ячеек — весь лист
+            title, a1 = a1, ''
+        if title.startswith("'") and title.endswith("'"):
+            title = title[1:-1].replace("''", "'")
+        return title, a1_range_to_grid_range(a1) if a1 else {}
+
+    def has(self, spreadsheet_id, title):
+        return (spreadsheet_id, title) in self._loaded
+
+    def last_row(self, spreadsheet_id, title):
+        """Номер последней заполненной строки (с единицы) среди загруженных ячеек"""
+        cells = self._cells.get((spreadsheet_id, title), {})
+        return max((row for row, _ in cells), default=-1) + 1
+
+    def find_row(self, spreadsheet_id, title, value, col=0):
+        """Номер первой строки (с единицы), в столбце col (с нуля) которой стоит value, или None"""
+        cells = self._cells.get((spreadsheet_id, title), {})
+        rows = [row for (row, column), cell in cells.items() if column == col and cell == value]
+        return min(rows) + 1 if rows else None
@@ -1,16 +1,23 @@
 import gspread
-from google.oauth2.service_account import Credentials
+from gspread.utils import a1_range_to_grid_range, a1_to_rowcol, rowcol_to_a1
 import logging
 import config
 import config_placement
 import pandas as pd
+import re
+import threading
 from datetime import datetime
+import sheet_batch
 from data_processing import process_common_kpi
 from data_processing import parse_common_kpi_result
 from data_processing import format_duration
+from data_processing import format_date_range
 
 logger = logging.getLogger(__name__)
 
+# Листы с авто-определением следующей строки (новая неделя — новая строка)
+AUTO_ROW_SHEETS = ('Services', 'TF_SR')
+
 def update_sheet_with_dates(client, df, config_key, data_name, value=None, dates=None):
     """Обновление данных с добавлением информации о датах"""
     try:
@@ -18,7 +25,7 @@ def update_sheet_with_dates(client, df, config_key, data_name, value=None, dates
             logger.info(f"Обновление данных за период: {dates['start_week']} - {dates['end_week']}")
         
         # Основная логика размещения данных остается без изменений
-        return update_sheet_precise(client, df, config_key, data_name, value)
+        return update_sheet_precise(PlacementSession(client), df, config_key, data_name, value)
     except Exception as e:
         logger.error(f"Ошибка при обновлении данных с датами: {e}")
         return False
@@ -38,7 +45,7 @@ def create_backup_entry(client, query_name, df, dates):
                 'data': [str(parsed_data)]
             })
             
-            update_sheet_precise(client, backup_df, 'backup_common_kpi', None)
+            update_sheet_precise(PlacementSession(client), backup_df, 'backup_common_kpi', None)
             logger.info("Резервная копия common_kpi создана")
         
         return True
@@ -78,8 +85,281 @@ def format_timedelta_for_sheets(timedelta_value):
     
     return time_str
 
-def update_sheet_precise(client, df, config_key, data_name, value=None):
-    """Размещение данных в Google Sheets согласно конфигурации"""
+def load_sheet_mirror(handles, mirror):
+    """Загружает в зеркало то, что размещение читает из листов: по одному batchGet на таблицу.
+
+    Читаются только листы с авто-строкой (AUTO_ROW_SHEETS): столбец A (подписи недель)
+    и столбцы размещения — по ним ищутся последняя заполненная строка и строка недели.
+    """
+    ranges = {}  # spreadsheet_id -> {лист: [диапазоны]}
+    for config_data in config_placement.PLACEMENT_CONFIG.values():
+        sheet_name = config_data['sheet_name']
+        if config_data['data_type'] == 'table' or sheet_name not in AUTO_ROW_SHEETS:
+            continue
+        spreadsheet_id = get_spreadsheet_id(config_data['spreadsheet_id'])
+        columns = ranges.setdefault(spreadsheet_id, {}).setdefault(sheet_name, ['A:A'])
+        for cell_address in config_data['placement'].values():
+            addresses = cell_address.values() if isinstance(cell_address, dict) else [cell_address]
+            for address in addresses:
+                col = re.sub(r"\d+", "", address)
+                if f"{col}:{col}" not in columns:
+                    columns.append(f"{col}:{col}")
+
+    for spreadsheet_id, ranges_by_sheet in ranges.items():
+        try:
+            mirror.load(handles.spreadsheet(spreadsheet_id), ranges_by_sheet)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки зеркала таблицы {spreadsheet_id}: {e}")
+
+def last_used_row(worksheet, mirror=None):
+    """Номер последней заполненной строки листа: из зеркала, если лист загружен, иначе get_all_values"""
+    if mirror is not None and mirror.has(worksheet.spreadsheet.id, worksheet.title):
+        return mirror.last_row(worksheet.spreadsheet.id, worksheet.title)
+    return len(worksheet.get_all_values())
+
+def week_label_row(worksheet, label, mirror=None):
+    """Строка листа, в столбце A которой стоит подпись недели label, или None (неделя ещё не размещена)"""
+    if mirror is not None and mirror.has(worksheet.spreadsheet.id, worksheet.title):
+        return mirror.find_row(worksheet.spreadsheet.id, worksheet.title, label)
+    values = worksheet.col_values(1)
+    return next((row for row, value in enumerate(values, start=1) if value == label), None)
+
+def write_cells(worksheet, cell_range, values, value_input_option='RAW', plan=None):
+    """Запись значений в лист: в план пакетной записи (если передан) или сразу через API"""
+    if plan is not None:
+        plan.add(worksheet, cell_range, values, value_input_option)
+        return
+    if config.SHEETS_DEBUG.get('dry_run'):
+        return
+    worksheet.update(cell_range, values, value_input_option=value_input_option)
+    if config.SHEETS_DEBUG.get('verify_writes'):
+        if ':' in cell_range:
+            back = worksheet.get(cell_range)
+        else:
+            back = worksheet.acell(cell_range).value
+        logger.info(f"verify {cell_range}: '{back}'")
+
+def update_cells_request(worksheet, cell_range, values):
+    """Запрос updateCells: значения записываются как текст (аналог RAW) начиная с левой верхней ячейки"""
+    grid = a1_range_to_grid_range(cell_range, worksheet.id)
+    return {'updateCells': {
+        'start': {
+            'sheetId': worksheet.id,
+            'rowIndex': grid.get('startRowIndex', 0),
+            'columnIndex': grid.get('startColumnIndex', 0),
+        },
+        'rows': [{'values': [{'userEnteredValue': {'stringValue': str(val)}} for val in row]} for row in values],
+        'fields': 'userEnteredValue',
+    }}
+
+def send_requests(worksheet, requests, expected=None, plan=None):
+    """Отправка запросов spreadsheets.batchUpdate одним вызовом: в план или сразу через API.
+
+    expected — [(диапазон, значения)] для отложенной проверки записи.
+    """
+    if plan is not None:
+        plan.add_requests(worksheet, requests, expected)
+        return
+    if config.SHEETS_DEBUG.get('dry_run'):
+        return
+    worksheet.spreadsheet.batch_update({'requests': requests})
+    if config.SHEETS_DEBUG.get('verify_writes'):
+        for cell_range, _ in expected or []:
+            logger.info(f"verify {cell_range}: '{worksheet.get(cell_range)}'")
+
+def format_table_frame(df):
+    """Копия таблицы для вставки: timedelta -> HH:MM:SS.microseconds"""
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_timedelta64_dtype(df[col]):
+            df[col] = df[col].apply(lambda x: format_duration(x) if hasattr(x, 'total_seconds') else x)
+    return df
+
+def update_table_chunks(session, chunks, config_key):
+    """Потоковая вставка таблицы (data_type 'table') по чанкам из database.iter_query_chunks.
+
+    Каждый чанк записывается сразу отдельным запросом в обход плана пакетной записи,
+    поэтому в памяти держится только текущий чанк. Чанки пишутся поверх прежних строк,
+    после последнего чанка очищается только хвост прежней таблицы (строки ниже и столбцы
+    правее новой). Пустой результат лист не трогает; при ошибке посреди потока хвост не
+    очищается, ошибка пробрасывается дальше. Возвращает число записанных строк.
+    """
+    config_data = config_placement.PLACEMENT_CONFIG[config_key]
+    spreadsheet_id = get_spreadsheet_id(config_data['spreadsheet_id'])
+    worksheet = session.worksheet(spreadsheet_id, config_data['sheet_name'])
+
+    start_cell = config_data['placement']['start_cell']
+    start_col = ''.join(filter(str.isalpha, start_cell))
+    first_row = int(''.join(filter(str.isdigit, start_cell)))
+    next_row = first_row
+    width = 0
+    rows = 0
+    try:
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            if rows == 0:
+                width = len(chunk.columns)
+                write_cells(worksheet, start_cell, [chunk.columns.tolist()])
+                next_row += 1
+            values = format_table_frame(chunk).values.tolist()
+            data_range = f"{start_col}{next_row}"
+            if config.SHEETS_DEBUG.get('log_ranges'):
+                logger.info(f"table chunk -> {data_range} rows={len(values)} cols={len(values[0])}")
+            write_cells(worksheet, data_range, values)
+            next_row += len(values)
+            rows += len(values)
+    except Exception:
+        if rows:
+            logger.error(f"Таблица {config_key} вставлена частично ({rows} строк): ниже могут остаться прежние строки")
+        raise
+    if rows:
+        clear_table_tail(worksheet, start_col, first_row, next_row, width)
+    logger.info(f"Таблица {config_key} вставлена по чанкам: {rows} строк")
+    return rows
+
+def clear_table_tail(worksheet, start_col, first_row, next_row, width):
+    """Очистка остатка прежней таблицы: строки начиная с next_row и столбцы правее новой таблицы"""
+    if config.SHEETS_DEBUG.get('dry_run'):
+        return
+    start_index = a1_to_rowcol(f"{start_col}1")[1]
+    last_col = rowcol_to_a1(1, worksheet.col_count).rstrip('0123456789')
+    ranges = [f"{start_col}{next_row}:{last_col}"]
+    if start_index + width <= worksheet.col_count:
+        right_col = rowcol_to_a1(1, start_index + width).rstrip('0123456789')
+        ranges.append(f"{right_col}{first_row}:{last_col}{next_row - 1}")
+    if config.SHEETS_DEBUG.get('log_ranges'):
+        logger.info(f"table tail clear -> {', '.join(ranges)}")
+    worksheet.batch_clear(ranges)
+
+def format_status_values(df):
+    """Значения первой строки результата статусов для вставки в столбец"""
+    row = df.iloc[0]  # Берем первую строку
+    new_values = []
+    for col in df.columns:
+        val = row[col]
+        if pd.isna(val) or val is None:
+            new_values.append("")
+        elif isinstance(val, pd.Timedelta):
+            new_values.append(format_timedelta_for_sheets(val))
+        else:
+            new_values.append(str(val))
+    return new_values
+
+def week_row_hint(sheet_name):
+    """Нижняя граница строки недели: Services -> 121; TF_SR -> 74 (строка 73 уже занята)"""
+    return 121 if sheet_name == 'Services' else 74 if sheet_name == 'TF_SR' else 2
+
+def sheet_key(worksheet):
+    try:
+        return f"{worksheet.spreadsheet.id}:{worksheet.title}"
+    except Exception:
+        return worksheet.title
+
+
+class PlacementSession:
+    """Контекст одного запуска размещения, передаётся в update_sheet_precise явно.
+
+    Владеет кэшем таблиц и листов (handles), зеркалом листов (mirror), планом записи
+    (plan, None — прямая запись), датами размещаемой недели и выбранными строками недели
+    на листах Services/TF_SR, а также счётчиками размещений. Неделя, уже подписанная
+    в столбце A (перезапуск, backfill), перезаписывается в своей строке, новые недели
+    добавляются после занятых строк. Сессии независимы: несколько
+    запусков или периодов в одном процессе не мешают друг другу, а выбор строки недели
+    защищён блокировкой, поэтому размещать можно из нескольких потоков.
+    """
+
+    def __init__(self, client, plan=None, week=None):
+        self.client = client
+        self.plan = plan
+        self.handles = sheet_batch.WorksheetCache(client)
+        self.mirror = sheet_batch.SheetMirror()
+        self.week = week
+        self.rows = {}        # 'spreadsheet_id:лист' -> строка недели
+        self.appended = {}    # 'spreadsheet_id:лист' -> сколько новых строк недель уже выбрано
+        self.dated = set()    # листы, где строка недели уже подписана датами
+        self.placed = set()   # цели PLACEMENT_CONFIG, размещённые успешно
+        self.counters = {'placed': 0, 'failed': 0}
+        self._lock = threading.RLock()
+        self._mirror_loaded = False
+
+    def start_week(self, week):
+        """Следующая неделя пакета (backfill): строки недели выбираются заново"""
+        with self._lock:
+            self.week = week
+            self.rows = {}
+            self.dated = set()
+
+    def load_mirror(self):
+        """Зеркало листов загружается один раз за сессию"""
+        with self._lock:
+            if not self._mirror_loaded:
+                load_sheet_mirror(self.handles, self.mirror)
+                self._mirror_loaded = True
+
+    def worksheet(self, spreadsheet_id, sheet_name):
+        return self.handles.worksheet(spreadsheet_id, sheet_name)
+
+    def week_row(self, worksheet, base_row_hint):
+        """Строка недели листа: выбирается один раз за неделю, чтобы все значения недели попали в неё.
+
+        Строка с подписью недели в столбце A, если неделя уже на листе; иначе первая свободная
+        после занятых строк и строк новых недель, выбранных раньше в этой сессии (их записи ещё в плане).
+        """
+        key = sheet_key(worksheet)
+        with self._lock:
+            if key not in self.rows:
+                try:
+                    existing = self._labelled_row(worksheet)
+                except Exception as e:
+                    logger.warning(f"Не удалось найти строку недели на листе {worksheet.title}: {e}")
+                    existing = None
+                if existing is not None:
+                    logger.info(f"Неделя уже на листе {worksheet.title} в строке {existing}, значения будут перезаписаны")
+                    self.rows[key] = existing
+                else:
+                    try:
+                        next_row = max(last_used_row(worksheet, self.mirror) + 1, base_row_hint)
+                    except Exception:
+                        next_row = base_row_hint
+                    self.rows[key] = next_row + self.appended.get(key, 0)
+                    self.appended[key] = self.appended.get(key, 0) + 1
+            return self.rows[key]
+
+    def _labelled_row(self, worksheet):
+        if not self.week or worksheet.title not in AUTO_ROW_SHEETS:
+            return None
+        label = format_date_range(self.week['start_week'], self.week['end_week'])
+        return week_label_row(worksheet, label, self.mirror)
+
+    def claim_date_cell(self, worksheet):
+        """Строка для подписи недели, если лист ещё не подписан (иначе None)"""
+        key = sheet_key(worksheet)
+        with self._lock:
+            if key in self.dated:
+                return None
+            self.dated.add(key)
+            return self.week_row(worksheet, week_row_hint(worksheet.title))
+
+    def record(self, target, placed):
+        with self._lock:
+            self.counters['placed' if placed else 'failed'] += 1
+            if placed:
+                self.placed.add(target)
+
+    def log_summary(self):
+        logger.info(f"Размещение: успешно {self.counters['placed']}, с ошибкой или пропущено {self.counters['failed']}")
+        return dict(self.counters)
+
+def update_sheet_precise(session, df, config_key, data_name, value=None):
+    """Размещение данных в Google Sheets согласно конфигурации.
+
+    session (PlacementSession) — контекст запуска: листы берутся из его кэша, поиск строк
+    идёт через зеркало, записи копятся в плане до plan.flush() (или отправляются
+    сразу, если плана нет). Даты недели сессии подписывают строку на листах Services/TF_SR.
+    """
+    plan = session.plan
+    week = session.week
     logger.info(f"update_sheet_precise: config_key={config_key}, data_name={data_name}, df is not None={df is not None}, value={value}")
     try:
         if config_key not in config_placement.PLACEMENT_CONFIG:
@@ -94,15 +374,13 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
         logger.info(f"Открываем таблицу {spreadsheet_id}, лист {sheet_name}")
         
         try:
-            # Получаем таблицу и лист
-            spreadsheet = client.open_by_key(spreadsheet_id)
-            worksheet = spreadsheet.worksheet(sheet_name)
+            # Получаем лист из кэша сессии
+            worksheet = session.worksheet(spreadsheet_id, sheet_name)
         except gspread.exceptions.WorksheetNotFound:
             logger.error(f"Лист '{sheet_name}' не найден в таблице {spreadsheet_id}")
             # Попробуем получить список всех листов для отладки
             try:
-                all_sheets = [ws.title for ws in spreadsheet.worksheets()]
-                logger.info(f"Доступные листы: {all_sheets}")
+                logger.info(f"Доступные листы: {session.handles.titles(spreadsheet_id)}")
             except:
                 pass
             return False
@@ -112,63 +390,20 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
         
         # Единоразово записываем диапазон дат недели в первую ячейку новой строки для листов TF_SR и Services
         try:
-            if sheet_name in ('TF_SR', 'Services'):
-                if not hasattr(update_sheet_precise, '_date_written_cache'):
-                    update_sheet_precise._date_written_cache = {}
-                cache_key = f"{worksheet.spreadsheet.id}:{worksheet.title}"
-                if not update_sheet_precise._date_written_cache.get(cache_key):
-                    # Определяем следующую свободную строку
-                    base_row_hint = 121 if sheet_name == 'Services' else 74 if sheet_name == 'TF_SR' else 2
-                    current_row = len(worksheet.get_all_values()) + 1
-                    current_row = max(current_row, base_row_hint)
+            if sheet_name in AUTO_ROW_SHEETS:
+                current_row = session.claim_date_cell(worksheet)
+                # Человекочитаемый диапазон дат недели (Пн-Вс)
+                if current_row is not None and week:
                     date_cell = f"A{current_row}"
-
-                    # Формируем человекочитаемый диапазон дат (Пн-Вс)
-                    from debug_utils import format_week_date_range
-                    from datetime import datetime, timedelta
-                    start_date = config.DEBUG_SETTINGS.get('test_date')
-                    start_dt = datetime.strptime(start_date, '%Y-%m-%d')
-                    # Вс включительно — +6 дней
-                    end_dt = start_dt + timedelta(days=6)
-                    date_range = format_week_date_range(start_dt.strftime('%Y-%m-%d'), end_dt.strftime('%Y-%m-%d'))
-
+                    date_range = format_date_range(week['start_week'], week['end_week'])
                     logger.info(f"Записываем диапазон дат недели в {sheet_name}!{date_cell}: '{date_range}'")
-                    if not config.SHEETS_DEBUG.get('dry_run'):
-                        worksheet.update(date_cell, [[date_range]], value_input_option='RAW')
-                        if config.SHEETS_DEBUG.get('verify_writes'):
-                            back = worksheet.acell(date_cell).value
-                            logger.info(f"verify {date_cell}: '{back}'")
-                    # Зафиксируем текущую целевую строку в row_cache, чтобы все значения этой недели попали в неё
-                    if not hasattr(update_sheet_precise, '_row_cache'):
-                        update_sheet_precise._row_cache = {}
-                    key = f"{worksheet.spreadsheet.id}:{worksheet.title}"
-                    update_sheet_precise._row_cache[key] = current_row
-                    update_sheet_precise._date_written_cache[cache_key] = True
+                    write_cells(worksheet, date_cell, [[date_range]], 'RAW', plan)
         except Exception as e:
             logger.error(f"Ошибка записи даты недели: {e}")
         
-        # ... остальной код функции
-        
         # Вспомогательные функции
-        # Кэширование вычисленного next_row на время вызова (чтобы все записи встали в одну строку)
-        if not hasattr(update_sheet_precise, '_row_cache'):
-            update_sheet_precise._row_cache = {}
-        def cache_key(worksheet):
-            try:
-                return f"{worksheet.spreadsheet.id}:{worksheet.title}"
-            except Exception:
-                return worksheet.title
-        def find_next_row_for_sheet(worksheet, base_row_hint: int) -> int:
-            key = cache_key(worksheet)
-            if key in update_sheet_precise._row_cache:
-                return update_sheet_precise._row_cache[key]
-            try:
-                last_row = len(worksheet.get_all_values())
-                next_row = max(last_row + 1, base_row_hint)
-            except Exception:
-                next_row = base_row_hint
-            update_sheet_precise._row_cache[key] = next_row
-            return next_row
+        # Строка недели выбирается сессией один раз (чтобы все записи встали в одну строку)
+        find_next_row_for_sheet = session.week_row
 
         def increment_formula_row(cell_value: str) -> str:
             # Примитивный инкремент ссылки TF_SR!X73 -> TF_SR!X74
@@ -207,17 +442,12 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
                     except Exception:
                         formula = "=1-0%"
                 logger.info(f"E16: Финальная формула: '{formula}'")
-                if not config.SHEETS_DEBUG.get('dry_run'):
-                    # Записываем формулу
-                    try:
-                        worksheet.update(target_cell, [[formula]], value_input_option='USER_ENTERED')
-                        logger.info(f"Формула записана: {formula}")
-                    except Exception as e:
-                        logger.error(f"Ошибка записи формулы: {e}")
-                    
-                    if config.SHEETS_DEBUG.get('verify_writes'):
-                        back = worksheet.acell(target_cell).value
-                        logger.info(f"verify {target_cell}: '{back}'")
+                # Записываем формулу
+                try:
+                    write_cells(worksheet, target_cell, [[formula]], 'USER_ENTERED', plan)
+                    logger.info(f"Формула записана: {formula}")
+                except Exception as e:
+                    logger.error(f"Ошибка записи формулы: {e}")
                 logger.info(f"Обновлена формула в {target_cell}: {formula}")
                 return True
             except Exception as e:
@@ -244,11 +474,7 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
                     
                     if config.SHEETS_DEBUG.get('log_ranges'):
                         logger.info(f"single_value auto_row -> {new_cell} value={formatted_value}")
-                    if not config.SHEETS_DEBUG.get('dry_run'):
-                        worksheet.update(new_cell, [[formatted_value]])
-                        if config.SHEETS_DEBUG.get('verify_writes'):
-                            back = worksheet.acell(new_cell).value
-                            logger.info(f"verify {new_cell}: '{back}'")
+                    write_cells(worksheet, new_cell, [[formatted_value]], plan=plan)
                     return True
                 except Exception as e:
                     logger.error(f"Ошибка single_value auto_row для {config_key}: {e}")
@@ -257,11 +483,7 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
             # Дефолт: запись в указанный адрес
             if config.SHEETS_DEBUG.get('log_ranges'):
                 logger.info(f"single_value -> {cell_address} value={value}")
-            if not config.SHEETS_DEBUG.get('dry_run'):
-                worksheet.update(cell_address, [[str(value)]])
-                if config.SHEETS_DEBUG.get('verify_writes'):
-                    back = worksheet.acell(cell_address).value
-                    logger.info(f"verify {cell_address}: '{back}'")
+            write_cells(worksheet, cell_address, [[str(value)]], plan=plan)
             return True
         
         elif data_type == 'range' and df is not None:
@@ -272,11 +494,7 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
                     value = df[data_name].iloc[0] if not df.empty else ''
                     if config.SHEETS_DEBUG.get('log_ranges'):
                         logger.info(f"range -> {cell_address} value={value}")
-                    if not config.SHEETS_DEBUG.get('dry_run'):
-                        worksheet.update(cell_address, [[str(value)]])
-                        if config.SHEETS_DEBUG.get('verify_writes'):
-                            back = worksheet.acell(cell_address).value
-                            logger.info(f"verify {cell_address}: '{back}'")
+                    write_cells(worksheet, cell_address, [[str(value)]], plan=plan)
                 return True
             return False
         
@@ -285,21 +503,19 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
             start_cell = config_data['placement']['start_cell']
             
             # Конвертируем timedelta в нужный формат
-            df = df.copy()
-            for col in df.columns:
-                if df[col].dtype == 'timedelta64[ns]':
-                    df[col] = df[col].apply(lambda x: format_duration(x) if hasattr(x, 'total_seconds') else x)
+            df = format_table_frame(df)
 
             # Очищаем старые данные
-            if not config.SHEETS_DEBUG.get('dry_run'):
+            if plan is not None:
+                plan.clear(worksheet)
+            elif not config.SHEETS_DEBUG.get('dry_run'):
                 worksheet.clear()
             
             # Вставляем заголовки
             headers = df.columns.tolist()
             if config.SHEETS_DEBUG.get('log_ranges'):
                 logger.info(f"table headers -> {start_cell} cols={len(headers)}")
-            if not config.SHEETS_DEBUG.get('dry_run'):
-                worksheet.update(start_cell, [headers])
+            write_cells(worksheet, start_cell, [headers], plan=plan)
     
     # Вставляем данные
             values = df.values.tolist()
@@ -309,8 +525,7 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
                 data_range = f"{start_col}{start_row}"
                 if config.SHEETS_DEBUG.get('log_ranges'):
                     logger.info(f"table values -> {data_range} rows={len(values)} cols={len(values[0])}")
-                if not config.SHEETS_DEBUG.get('dry_run'):
-                    worksheet.update(data_range, values)
+                write_cells(worksheet, data_range, values, plan=plan)
             
             logger.info(f"Вставлена таблица размером {len(values)}x{len(values[0])}")
             return True
@@ -338,12 +553,38 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
                             new_cell = f"{col}{next_row}"
                             if config.SHEETS_DEBUG.get('log_ranges'):
                                 logger.info(f"common_kpi auto_row -> {metric_name}.{value_key} {new_cell} value={value}")
-                            if not config.SHEETS_DEBUG.get('dry_run'):
-                                worksheet.update(new_cell, [[str(value)]])
-                                if config.SHEETS_DEBUG.get('verify_writes'):
-                                    back = worksheet.acell(new_cell).value
-                                    logger.info(f"verify {new_cell}: '{back}'")
-            # Не возвращаемся здесь, продолжаем для других операций
+                            write_cells(worksheet, new_cell, [[str(value)]], plan=plan)
+            return True
+
+        if data_type == 'rolling_columns' and df is not None:
+            # Скользящее окно столбцов: сдвиг значений и вставка новых одним атомарным batchUpdate
+            try:
+                placement = config_data['placement']
+                requests = []
+                for shift in placement['shift']:
+                    if config.SHEETS_DEBUG.get('log_ranges'):
+                        logger.info(f"shift {shift['source']} -> {shift['destination']}")
+                    requests.append({'copyPaste': {
+                        'source': a1_range_to_grid_range(shift['source'], worksheet.id),
+                        'destination': a1_range_to_grid_range(shift['destination'], worksheet.id),
+                        'pasteType': 'PASTE_VALUES',
+                    }})
+
+                expected = []
+                if not df.empty:
+                    values_range = placement['values']
+                    new_values = [[val] for val in format_status_values(df)]
+                    if config.SHEETS_DEBUG.get('log_ranges'):
+                        logger.info(f"insert {values_range} new_values={new_values}")
+                    requests.append(update_cells_request(worksheet, values_range, new_values))
+                    expected.append((values_range, new_values))
+
+                send_requests(worksheet, requests, expected, plan)
+                logger.info(f"Сдвиг окна столбцов и вставка {config_key} выполнены")
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка сдвига окна столбцов {config_key}: {e}")
+                return False
 
         # Специальные операции для листа status: сдвиги и формулы
         logger.info(f"DEBUG: config_key={config_key}, df is not None={df is not None}, data_name={data_name}")
@@ -360,83 +601,14 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
             logger.info(f"STATUS {config_key}: df.shape={df.shape}, columns={list(df.columns)}")
             logger.info(f"STATUS {config_key}: df.head(3)=\n{df.head(3)}")
             
-            if config_key == 'statuses_payout_reward':
-                # Сдвиг D4:D16 -> C4:C16, E4:E15 -> D4:D16, вставка E5:E15
-                try:
-                    # Диапазоны
-                    range_c = 'C4:C16'
-                    range_d = 'D4:D16'
-                    range_e_4_15 = 'E4:E15'
-                    range_e_5_15 = 'E5:E15'
-
-                    # Читаем текущие значения столбцов D и E
-                    values_d = worksheet.get(range_d)
-                    values_e_4_15 = worksheet.get(range_e_4_15)
-
-                    # Сдвиг: D -> C
-                    if config.SHEETS_DEBUG.get('log_ranges'):
-                        logger.info(f"shift D->C {range_d} -> {range_c}")
-                    if values_d and not config.SHEETS_DEBUG.get('dry_run'):
-                        worksheet.update(range_c, values_d)
-
-                    # Сдвиг: E4:E15 -> D4:D16
-                    if config.SHEETS_DEBUG.get('log_ranges'):
-                        logger.info(f"shift E4:E15->D4:D16 {range_e_4_15} -> {range_d}")
-                    if values_e_4_15 and not config.SHEETS_DEBUG.get('dry_run'):
-                        worksheet.update(range_d, values_e_4_15)
-
-                    # Вставляем новые значения в E5:E15 с форматированием времени
-                    if not df.empty:
-                        row = df.iloc[0]  # Берем первую строку
-                        new_values = []
-                        for col in df.columns:
-                            val = row[col]
-                            if pd.isna(val) or val is None:
-                                new_values.append("")
-                            elif isinstance(val, pd.Timedelta):
-                                formatted_val = format_timedelta_for_sheets(val)
-                                new_values.append(formatted_val)
-                            else:
-                                new_values.append(str(val))
-                        
-                        if config.SHEETS_DEBUG.get('log_ranges'):
-                            logger.info(f"insert E5:E15 new_values={new_values}")
-                        if not config.SHEETS_DEBUG.get('dry_run'):
-                            # Правильный формат для Google Sheets: список списков
-                            worksheet.update(range_e_5_15, [[val] for val in new_values], value_input_option='RAW')
-                            if config.SHEETS_DEBUG.get('verify_writes'):
-                                verify_values = worksheet.get(range_e_5_15)
-                                logger.info(f"verify E5:E15: {verify_values}")
-
-                    logger.info("Сдвиги и вставки statuses_payout_reward выполнены")
-                    return True
-                except Exception as e:
-                    logger.error(f"Ошибка обработки statuses_payout_reward: {e}")
-                    return False
-            
-            elif config_key == 'statuses_partner_liability':
+            if config_key == 'statuses_partner_liability':
                 # Вставка значений в C20:C25
                 try:
                     if not df.empty:
-                        row = df.iloc[0]  # Берем первую строку
-                        new_values = []
-                        for col in df.columns:
-                            val = row[col]
-                            if pd.isna(val) or val is None:
-                                new_values.append("")
-                            elif isinstance(val, pd.Timedelta):
-                                formatted_val = format_timedelta_for_sheets(val)
-                                new_values.append(formatted_val)
-                            else:
-                                new_values.append(str(val))
-                        
+                        new_values = format_status_values(df)
                         if config.SHEETS_DEBUG.get('log_ranges'):
                             logger.info(f"insert C20:C25 new_values={new_values}")
-                        if not config.SHEETS_DEBUG.get('dry_run'):
-                            worksheet.update('C20:C25', [[val] for val in new_values], value_input_option='RAW')
-                            if config.SHEETS_DEBUG.get('verify_writes'):
-                                verify_values = worksheet.get('C20:C25')
-                                logger.info(f"verify C20:C25: {verify_values}")
+                        write_cells(worksheet, 'C20:C25', [[val] for val in new_values], 'RAW', plan)
 
                     logger.info("Вставки statuses_partner_liability выполнены")
                     return True
@@ -467,11 +639,7 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
                         
                         if config.SHEETS_DEBUG.get('log_ranges'):
                             logger.info(f"auto_row -> {new_cell} value={formatted_value}")
-                        if not config.SHEETS_DEBUG.get('dry_run'):
-                            worksheet.update(new_cell, [[formatted_value]])
-                            if config.SHEETS_DEBUG.get('verify_writes'):
-                                back = worksheet.acell(new_cell).value
-                                logger.info(f"verify {new_cell}: '{back}'")
+                        write_cells(worksheet, new_cell, [[formatted_value]], plan=plan)
                         # Не возвращаемся здесь, продолжаем для других операций
             except Exception as e:
                 logger.error(f"Ошибка авто-строки для {config_key}: {e}")
@@ -487,12 +655,11 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
             try:
                 logger.info("Начинаем инкремент ссылок TF_SR в I3/I5/I6")
                 
-                # Сначала найдем текущую строку TF_SR (последнюю заполненную)
-                base_row_hint = 74 if sheet_name == 'TF_SR' else 74
-                current_tf_sr_row = find_next_row_for_sheet(worksheet, base_row_hint) - 1
-                next_tf_sr_row = current_tf_sr_row + 1
+                # Строка недели на листе TF_SR (уже выбрана размещением значений TF_SR этого запуска)
+                tf_sr_worksheet = session.worksheet(spreadsheet_id, 'TF_SR')
+                next_tf_sr_row = find_next_row_for_sheet(tf_sr_worksheet, week_row_hint('TF_SR'))
                 
-                logger.info(f"Текущая строка TF_SR: {current_tf_sr_row}, следующая: {next_tf_sr_row}")
+                logger.info(f"Строка недели TF_SR: {next_tf_sr_row}")
                 
                 # Определяем формулы для J3:J6 и L3:L6 согласно требованиям локали RU (с ;)
                 formulas = {
@@ -508,23 +675,16 @@ def update_sheet_precise(client, df, config_key, data_name, value=None):
                 
                 for cell, formula in formulas.items():
                     logger.info(f"Устанавливаем формулу в {cell}: '{formula}'")
-                    if not config.SHEETS_DEBUG.get('dry_run'):
+                    try:
+                        # USER_ENTERED гарантирует интерпретацию формулы без ведущей кавычки
+                        write_cells(worksheet, cell, [[formula]], 'USER_ENTERED', plan)
+                    except Exception as e:
+                        logger.error(f"Ошибка установки формулы в {cell}: {e}")
+                        # Повторная попытка
                         try:
-                            # USER_ENTERED гарантирует интерпретацию формулы без ведущей кавычки
-                            worksheet.update(cell, [[formula]], value_input_option='USER_ENTERED')
-                            if config.SHEETS_DEBUG.get('verify_writes'):
-                                back = worksheet.acell(cell).value
-                                logger.info(f"verify {cell}: '{back}'")
-                        except Exception as e:
-                            logger.error(f"Ошибка установки формулы в {cell}: {e}")
-                            # Попробуем без value_input_option
-                            try:
-                                worksheet.update(cell, [[formula]], value_input_option='USER_ENTERED')
-                                if config.SHEETS_DEBUG.get('verify_writes'):
-                                    back = worksheet.acell(cell).value
-                                    logger.info(f"verify {cell} (fallback): '{back}'")
-                            except Exception as e2:
-                                logger.error(f"Ошибка установки формулы в {cell} (fallback): {e2}")
+                            write_cells(worksheet, cell, [[formula]], 'USER_ENTERED', plan)
+                        except Exception as e2:
+                            logger.error(f"Ошибка установки формулы в {cell} (fallback): {e2}")
                 
                 logger.info("Инкремент ссылок TF_SR в I3/I5/I6 выполнен")
                 return True
@@ -0,0 +1,157 @@
+import logging
+import random
+import re
+import threading
+import time
+import gspread
+import config
+
+logger = logging.getLogger(__name__)
+
+# Коды ответа, при которых запрос повторяется с задержкой
+RETRY_STATUS_CODES = (429, 503)
+
+# POST-запросы, повтор которых безопасен: значения перезаписываются теми же данными.
+# batchUpdate таблицы (сдвиги copyPaste) и append при повторе применились бы дважды
+IDEMPOTENT_ENDPOINT_PATTERN = re.compile(r'/values(:batch(Update|Get|Clear)(ByDataFilter)?|/[^/]+:clear)$')
+
+SPREADSHEET_ID_PATTERN = re.compile(r'/spreadsheets/([a-zA-Z0-9_-]+)')
+
+
+class TokenBucket:
+    """Ведро токенов: не больше capacity запросов за period секунд с равномерным пополнением"""
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Забирает токен, при необходимости ожидая пополнения. Возвращает время ожидания"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class RequestGate:
+    """Единая точка прохождения запросов к Sheets API.
+
+    Ограничивает темп чтений и записей квотой (по умолчанию 60 в минуту на пользователя),
+    повторяет запросы с экспоненциальной задержкой и джиттером при 429/503
+    и считает чтения/записи по каждой таблице за запуск. Неидемпотентные запросы
+    (batchUpdate таблицы, append) повторяются только при 429: с 503 сервер мог уже
+    применить запрос.
+    """
+
+    def __init__(self, reads_per_minute=60, writes_per_minute=60, max_retries=5, base_delay=1.0, max_delay=64.0):
+        self.buckets = {'reads': TokenBucket(reads_per_minute), 'writes': TokenBucket(writes_per_minute)}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {}  # spreadsheet_id -> {'reads', 'writes', 'retries', 'throttled_seconds'}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        settings = getattr(config, 'SHEETS_SETTINGS', {})
+        return cls(
+            reads_per_minute=settings.get('reads_per_minute', 60),
+            writes_per_minute=settings.get('writes_per_minute', 60),
+            max_retries=settings.get('max_retries', 5),
+        )
+
+    def call(self, method, endpoint, func, *args, **kwargs):
+        """Выполняет func(*args, **kwargs) с учётом квоты и повторами при 429/503"""
+        attempt = 0
+        while True:
+            spreadsheet_id, kind = self.acquire(method, endpoint)
+            try:
+                return func(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                delay = self.retry_delay(spreadsheet_id, kind, status, attempt, is_idempotent(method, endpoint))
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+
+    def acquire(self, method, endpoint):
+        """Ждёт токен квоты для запроса и учитывает его. Возвращает (id таблицы, 'reads' | 'writes')"""
+        kind = 'reads' if method.upper() == 'GET' else 'writes'
+        match = SPREADSHEET_ID_PATTERN.search(endpoint)
+        spreadsheet_id = match.group(1) if match else 'other'
+        waited = self.buckets[kind].acquire()
+        self._count(spreadsheet_id, kind, waited)
+        return spreadsheet_id, kind
+
+    def retry_delay(self, spreadsheet_id, kind, status, attempt, idempotent=True):
+        """Задержка перед повтором attempt+1 (экспоненциальная с джиттером) или None, если повторять не нужно.
+
+        Неидемпотентный запрос повторяется только при 429 (запрос отклонён квотой и не выполнялся).
+        """
+        if status not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+            return None
+        if not idempotent and status != 429:
+            logger.error(f"Sheets API {status} для {spreadsheet_id} ({kind}): запрос не повторяется, "
+                         f"он мог быть уже применён")
+            return None
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self._count(spreadsheet_id, 'retries')
+        logger.warning(f"Sheets API {status} для {spreadsheet_id} ({kind}), "
+                       f"повтор {attempt + 1}/{self.max_retries} через {delay:.1f} с")
+        return delay
+
+    def _count(self, spreadsheet_id, kind, waited=0.0):
+        with self._lock:
+            stats = self.stats.setdefault(spreadsheet_id, {'reads': 0, 'writes': 0, 'retries': 0, 'throttled_seconds': 0.0})
+            stats[kind] += 1
+            stats['throttled_seconds'] += waited
+
+    def reset(self):
+        """Сбрасывает счётчики (начало нового запуска)"""
+        with self._lock:
+            self.stats = {}
+
+    def log_summary(self):
+        """Пишет в лог счётчики запросов по таблицам за запуск"""
+        with self._lock:
+            stats = {key: dict(value) for key, value in self.stats.items()}
+        if not stats:
+            logger.info("Sheets API: запросов не было")
+            return stats
+        for spreadsheet_id, counters in stats.items():
+            logger.info(f"Sheets API {spreadsheet_id}: чтений={counters['reads']}, записей={counters['writes']}, "
+                        f"повторов={counters['retries']}, ожидание квоты={counters['throttled_seconds']:.1f} с")
+        return stats
+
+
+def is_idempotent(method, endpoint):
+    """Повтор запроса безопасен: чтения, PUT значений и пакетные запись/чтение/очистка значений"""
+    method = method.upper()
+    if method in ('GET', 'PUT'):
+        return True
+    return method == 'POST' and bool(IDEMPOTENT_ENDPOINT_PATTERN.search(endpoint.split('?', 1)[0]))
+
+
+def install(client, gate):
+    """Пропускает все HTTP-запросы клиента gspread через gate"""
+    transport = getattr(client, 'http_client', client)  # gspread 6 / gspread 5
+    request = transport.request
+
+    def gated_request(method, endpoint, *args, **kwargs):
+        return gate.call(method, endpoint, request, method, endpoint, *args, **kwargs)
+
+    transport.request = gated_request
+    return client